@@ -0,0 +1,342 @@
+#! /usr/bin/env python
+# encoding: utf-8
+
+'''
+Reproducible sphog benchmarks.
+
+Generates a synthetic gallery, then times the main build steps, in cold
+(nothing generated yet) and warm (no-op rebuild) modes:
+- Photo.__init__ (warm: with cached metadata)
+- _gen_image_copy
+- Album.prepare and Album.render
+- AlbumSet construction
+- a full main() run (-r -b)
+- memory used per Photo object (traced allocations, with cached metadata)
+- startup: importing sphog.app, --help and a no-op run (warm only), each in
+  a new interpreter
+
+Results are written as JSON. Given a previous result file (--compare),
+timings are compared and regressions are reported.
+'''
+
+from __future__ import print_function
+
+import os
+import os.path
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import subprocess
+import tempfile
+import statistics
+import tracemalloc
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+from sphog import app
+from sphog.album import Album
+from sphog.albumset import AlbumSet
+from sphog.imaging import _gen_image_copy
+from sphog.photo import Photo
+from sphog.settings import settings
+
+from synth import generate_site, clean_site
+
+# Modules which must not be loaded by the startup path (see _startup)
+HEAVY_MODULES = ('PIL', 'jinja2', 'tqdm', 'concurrent.futures.process')
+
+
+def _timeit(func, repeat, setup=None):
+    '''Runs `func` `repeat` times, returns timing statistics in seconds'''
+    timings = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return {
+        'min': min(timings),
+        'median': statistics.median(timings),
+        'max': max(timings),
+        'runs': repeat,
+        }
+
+def _run_python(code, cwd):
+    '''Runs `code` in a new python interpreter, returns its output'''
+    env = dict(os.environ, PYTHONPATH=REPO)
+    return subprocess.check_output(
+        [sys.executable, '-c', code],
+        cwd=cwd,
+        env=env,
+        universal_newlines=True
+        )
+
+def _startup(root, args):
+    '''
+    Returns the python code running main() with `args` in a new interpreter.
+    main() reads site.config from the script directory, i.e. `root`.
+    '''
+    return (
+        'import sys; sys.argv = {!r}; '
+        'from sphog.app import main; main()'
+        ).format([os.path.join(root, 'sphog.py')] + args)
+
+def heavy_imports(root):
+    '''Returns the heavy modules loaded by importing sphog.app'''
+    return _run_python(
+        'import sys, sphog.app; print(" ".join('
+        'm for m in {!r} if m in sys.modules))'.format(HEAVY_MODULES),
+        root
+        ).split()
+
+def photo_memory(photos, config, metas, count=10000):
+    '''
+    Returns the memory (in bytes) used per Photo object, measured on
+    `count` photos built from `photos` and their cached `metas`
+    '''
+    tracemalloc.start()
+    try:
+        start = tracemalloc.get_traced_memory()[0]
+        objects = [
+            Photo(photos[i % len(photos)], config, meta=metas[i % len(metas)])
+            for i in range(count)
+            ]
+        used = tracemalloc.get_traced_memory()[0] - start
+    finally:
+        tracemalloc.stop()
+    del objects
+    return used / float(count)
+
+def _first_album(root):
+    '''Returns the path to the first album of a synthetic site'''
+    set_path = os.path.join(root, sorted(
+        d for d in os.listdir(root) if d.startswith('set')
+        )[0])
+    return os.path.join(set_path, sorted(
+        d for d in os.listdir(set_path) if d.startswith('album')
+        )[0])
+
+def run(root, site_config, repeat, jobs):
+    '''
+    Runs all the benchmarks on the synthetic site in `root`. Returns the
+    timings, and the memory measurements.
+    '''
+    results = {}
+    album_path = _first_album(root)
+    photos = sorted(
+        os.path.join(album_path, 'photos', f)
+        for f in os.listdir(os.path.join(album_path, 'photos'))
+        if f.endswith('.jpg')
+        )
+    album = Album(site_config, path=album_path)
+    clean = lambda: clean_site(root)
+
+    # Photo.__init__: cold reads the photo headers, warm uses cached metadata
+    metas = [Photo(p, album.config).meta for p in photos]
+    results['photo_init'] = {
+        'cold': _timeit(
+            lambda: [Photo(p, album.config) for p in photos],
+            repeat
+            ),
+        'warm': _timeit(
+            lambda: [Photo(p, album.config, meta=m) for p, m in zip(photos, metas)],
+            repeat
+            ),
+        }
+
+    memory = {'photo': photo_memory(photos, album.config, metas)}
+
+    # _gen_image_copy: one preview-sized copy of each photo
+    out = os.path.join(tempfile.mkdtemp(prefix='sphog-bench-'), 'copy.jpg')
+    sizes = [Photo(p, album.config).get_preview_size() for p in photos]
+    results['gen_image_copy'] = {
+        'cold': _timeit(
+            lambda: [_gen_image_copy(p, out, s) for p, s in zip(photos, sizes)],
+            repeat
+            ),
+        }
+    shutil.rmtree(os.path.dirname(out))
+
+    # Album.prepare and Album.render
+    def prepare():
+        Album(site_config, path=album_path).prepare()
+    def render():
+        a = Album(site_config, path=album_path)
+        a._parse_photodir()
+        a.render()
+    results['album_prepare'] = {
+        'cold': _timeit(prepare, repeat, setup=clean),
+        'warm': _timeit(prepare, repeat),
+        }
+    results['album_render'] = {
+        'cold': _timeit(render, repeat, setup=clean),
+        'warm': _timeit(render, repeat),
+        }
+
+    # AlbumSet construction: scans the whole tree
+    def albumset():
+        AlbumSet(site_config, recurse=True, path=root)
+    results['albumset_init'] = {
+        'cold': _timeit(albumset, repeat, setup=clean),
+        'warm': _timeit(albumset, repeat),
+        }
+
+    # Full main() runs, building the whole tree
+    def main():
+        cwd = os.getcwd()
+        argv = sys.argv
+        os.chdir(root)
+        # main() reads site.config from the script directory
+        sys.argv = [
+            os.path.join(root, 'sphog.py'), '-q', '-r', '-b', '-j', str(jobs)
+            ]
+        try:
+            app.main()
+        finally:
+            sys.argv = argv
+            os.chdir(cwd)
+    results['main'] = {
+        'cold': _timeit(main, repeat, setup=clean),
+        'warm': _timeit(main, repeat),
+        }
+
+    # Startup: new interpreters, on the tree built by the main() runs
+    results['startup_import'] = {
+        'warm': _timeit(lambda: _run_python('import sphog.app', root), repeat),
+        }
+    results['startup_help'] = {
+        'warm': _timeit(
+            lambda: _run_python(_startup(root, ['--help']), root),
+            repeat
+            ),
+        }
+    results['startup_noop'] = {
+        'warm': _timeit(
+            lambda: _run_python(_startup(root, ['-q', '-r', '-b']), root),
+            repeat
+            ),
+        }
+    clean()
+    return results, memory
+
+def compare(results, baseline, threshold):
+    '''
+    Compares `results` with `baseline` (median timings, and memory). Returns
+    the list of regressions, i.e. timings slower (or memory larger) than the
+    baseline by more than `threshold` (a ratio).
+    '''
+    regressions = []
+    for name, modes in sorted(results['results'].items()):
+        for mode, stats in sorted(modes.items()):
+            try:
+                ref = baseline['results'][name][mode]['median']
+            except KeyError:
+                continue
+            ratio = stats['median'] / ref if ref > 0 else 1.0
+            print(u'{:<16} {:<5} {:>10.4f}s {:>10.4f}s {:>7.2f}x'.format(
+                name, mode, ref, stats['median'], ratio
+                ))
+            if ratio > 1 + threshold:
+                regressions.append((name, mode, ratio))
+    for name, size in sorted(results['memory'].items()):
+        ref = baseline.get('memory', {}).get(name)
+        if not ref:
+            continue
+        ratio = size / ref
+        print(u'{:<16} {:<5} {:>10.0f}B {:>10.0f}B {:>7.2f}x'.format(
+            name, 'mem', ref, size, ratio
+            ))
+        if ratio > 1 + threshold:
+            regressions.append((name, 'mem', ratio))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the sphog benchmarks')
+    parser.add_argument('-o', '--output', metavar='FILE', help='Write the JSON results to FILE (default: stdout)')
+    parser.add_argument('--compare', metavar='FILE', help='Compare the results with a previous JSON result file')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Regression threshold, as a ratio (default: 0.1)')
+    parser.add_argument('--sets', type=int, default=2, help='Number of album sets')
+    parser.add_argument('--albums', type=int, default=4, help='Number of albums per set')
+    parser.add_argument('--photos', type=int, default=20, help='Number of photos per album')
+    parser.add_argument('--resolution', default='4000x3000', help='Photo resolution (default: 4000x3000)')
+    parser.add_argument('--orientations', default='1,6,8,3', help='Exif orientations, used in turn (default: 1,6,8,3)')
+    parser.add_argument('--zipfile', action='store_true', help='Build album archives')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of runs per benchmark')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of jobs used by main() runs')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed used to generate photos')
+    parser.add_argument('--keep', metavar='DIR', help='Generate the site in DIR and keep it')
+    args = parser.parse_args()
+
+    params = {
+        'sets': args.sets,
+        'albums': args.albums,
+        'photos': args.photos,
+        'resolution': args.resolution,
+        'orientations': args.orientations,
+        'zipfile': args.zipfile,
+        'repeat': args.repeat,
+        'jobs': args.jobs,
+        'seed': args.seed,
+        }
+    root = args.keep or tempfile.mkdtemp(prefix='sphog-bench-')
+    settings.quiet = True
+    try:
+        site_config = generate_site(
+            root,
+            sets=args.sets,
+            albums=args.albums,
+            photos=args.photos,
+            resolution=tuple(int(x) for x in args.resolution.split('x')),
+            orientations=tuple(int(x) for x in args.orientations.split(',')),
+            zipfile=args.zipfile,
+            seed=args.seed
+            )
+        timings, memory = run(root, site_config, args.repeat, args.jobs)
+        results = {
+            'params': params,
+            'platform': {
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'system': platform.system(),
+                'cpus': os.cpu_count(),
+                },
+            'results': timings,
+            'memory': memory,
+            'heavy_imports': heavy_imports(root),
+            }
+    finally:
+        if args.keep is None:
+            shutil.rmtree(root)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as out:
+            out.write(output)
+    else:
+        print(output)
+
+    if results['heavy_imports']:
+        print(u'W: importing sphog.app loads {}'.format(
+            ', '.join(results['heavy_imports'])
+            ), file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('params') != params:
+            print(u'W: benchmark parameters differ from the baseline', file=sys.stderr)
+        regressions = compare(results, baseline, args.threshold)
+        for name, mode, ratio in regressions:
+            print(u'W: {} ({}) is {:.2f}x {}'.format(
+                name, mode, ratio, 'larger' if mode == 'mem' else 'slower'
+                ), file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
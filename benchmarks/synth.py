@@ -0,0 +1,136 @@
+# encoding: utf-8
+
+'''
+Synthetic gallery generator used by the benchmarks: creates a site tree with
+album sets, albums and JPEG photos of configurable sizes and Exif
+orientations.
+'''
+
+import os
+import os.path
+import random
+import codecs
+
+from PIL import Image
+
+# Exif orientation tag
+EXIF_ORIENTATION = 0x0112
+
+SITE_CONFIG = u'''[global]
+siteroot: {root}
+templatedir: {templatedir}
+
+[album]
+photodir: photos
+template: index.tmpl
+stylesheet: /css/index.white.css
+thumbnail: thumbnail.jpg
+thumbnail_size: 450
+zipfile: {zipfile}
+
+[photos]
+thumb_prefix: thumb_
+thumb_height: 290
+preview_prefix: preview_
+preview_height: 768
+
+[directory]
+desc: Album index
+stylesheet: /css/index.white.css
+thumbnail: album_thumbnail.jpg
+template: directory.tmpl
+'''
+
+
+def _write(path, content):
+    with codecs.open(path, 'wb', 'utf8') as out:
+        out.write(content)
+
+def _gen_photo(path, size, orientation, rng):
+    '''
+    Writes a JPEG photo of `size` pixels. The content is a smooth gradient
+    with some noise, so that it compresses like an actual photo would.
+    '''
+    base = Image.linear_gradient('L').resize(size)
+    noise = Image.effect_noise(size, rng.randint(20, 60))
+    img = Image.merge('RGB', (
+        base,
+        noise,
+        base.transpose(Image.FLIP_LEFT_RIGHT)
+        ))
+    exif = Image.Exif()
+    if orientation != 1:
+        exif[EXIF_ORIENTATION] = orientation
+    img.save(path, quality=90, exif=exif.tobytes())
+
+def generate_site(root, sets=2, albums=4, photos=20, resolution=(4000, 3000),
+                  orientations=(1, 6, 8, 3), zipfile=False, seed=0):
+    '''
+    Generates a synthetic site in `root`: `sets` album sets, each holding
+    `albums` albums of `photos` photos. Photos are `resolution` pixels large,
+    with Exif orientations taken from `orientations` in turn. Returns the
+    path to the site configuration file.
+    '''
+    rng = random.Random(seed)
+    templatedir = os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        'templates'
+        )
+    if not os.path.isdir(root):
+        os.makedirs(root)
+    root = os.path.abspath(root)
+    site_config = os.path.join(root, 'site.config')
+    _write(site_config, SITE_CONFIG.format(
+        root=root,
+        templatedir=templatedir,
+        zipfile='photos.zip' if zipfile else ''
+        ))
+    _write(
+        os.path.join(root, 'index.def'),
+        u'[directory]\ntitle: Benchmark\ndesc: Synthetic gallery\n'
+        )
+    count = 0
+    for s in range(sets):
+        set_path = os.path.join(root, 'set{:03d}'.format(s))
+        os.makedirs(set_path)
+        _write(
+            os.path.join(set_path, 'index.def'),
+            u'[directory]\ntitle: Set {0}\ndesc: Album set {0}\n'.format(s)
+            )
+        for a in range(albums):
+            album_path = os.path.join(set_path, 'album{:03d}'.format(a))
+            photodir = os.path.join(album_path, 'photos')
+            os.makedirs(photodir)
+            _write(
+                os.path.join(album_path, 'album.def'),
+                u'[album]\ntitle: Album {0}\ndesc: Album {0}\ndate: 2020\n'.format(a)
+                )
+            for p in range(photos):
+                orientation = orientations[count % len(orientations)]
+                _gen_photo(
+                    os.path.join(photodir, 'photo{:05d}.jpg'.format(p)),
+                    resolution,
+                    orientation,
+                    rng
+                    )
+                if p % 5 == 0:
+                    _write(
+                        os.path.join(photodir, 'photo{:05d}.desc'.format(p)),
+                        u'Photo {}\n'.format(p)
+                        )
+                count += 1
+    return site_config
+
+def clean_site(root, thumb_prefix='thumb_', preview_prefix='preview_'):
+    '''
+    Removes all the files generated by sphog from a synthetic site, so that
+    the next build starts cold
+    '''
+    generated = ('index.html', 'thumbnail.jpg', 'album_thumbnail.jpg',
+                 'photos.zip', '.sphog.cache')
+    for dirpath, dirnames, filenames in os.walk(root):
+        del dirnames  # unused
+        for f in filenames:
+            if (f in generated or f.startswith(thumb_prefix)
+                    or f.startswith(preview_prefix)):
+                os.remove(os.path.join(dirpath, f))
@@ -0,0 +1,77 @@
+// Loads the photos of large albums on demand while scrolling, from the JSON
+// chunks listed by the album manifest (see the chunk_size album option).
+// Photos are rendered with the #gallery-item template of the page.
+
+(function () {
+	var gallery = document.querySelector('[data-manifest]')
+	var template = document.getElementById('gallery-item')
+	if (!gallery || !template || !window.fetch) return
+
+	var offset = parseInt(gallery.dataset.offset, 10)
+	var chunks = null
+	var loading = false
+	var sentinel = document.createElement('div')
+	gallery.parentNode.insertBefore(sentinel, gallery.nextSibling)
+
+	function append(photo) {
+		var item = template.content.firstElementChild.cloneNode(true)
+		var ratio = photo.thumb_width * 220 / photo.thumb_height
+		var link = item.querySelector('a')
+		var img = item.querySelector('img')
+		item.style.width = ratio + 'px'
+		item.style.flexGrow = ratio
+		link.href = photo.href
+		link.title = photo.desc
+		link.dataset.pswpWidth = photo.width
+		link.dataset.pswpHeight = photo.height
+		link.dataset.pswpSrcset = photo.srcset
+		item.querySelector('i').style.paddingBottom =
+			(photo.thumb_height / photo.thumb_width * 100) + '%'
+		img.src = photo.thumb
+		img.alt = photo.desc
+		if (photo.desc) {
+			item.querySelector('.text').textContent = photo.desc
+		} else {
+			item.querySelector('.overlay').remove()
+		}
+		gallery.appendChild(item)
+	}
+
+	function isNearBottom() {
+		return sentinel.getBoundingClientRect().top < window.innerHeight * 2
+	}
+
+	function loadNext() {
+		if (loading || chunks === null) return
+		var chunk = chunks.find(function (c) {
+			return c.start <= offset && offset < c.start + c.count
+		})
+		if (!chunk) {
+			observer.disconnect()
+			return
+		}
+		loading = true
+		fetch(chunk.url).then(function (response) {
+			return response.json()
+		}).then(function (photos) {
+			photos.slice(offset - chunk.start).forEach(append)
+			offset = chunk.start + chunk.count
+			loading = false
+			if (isNearBottom()) loadNext()
+		}).catch(function () {
+			loading = false
+		})
+	}
+
+	var observer = new IntersectionObserver(function (entries) {
+		if (entries[0].isIntersecting) loadNext()
+	}, { rootMargin: '100% 0px' })
+
+	fetch(gallery.dataset.manifest).then(function (response) {
+		return response.json()
+	}).then(function (manifest) {
+		chunks = manifest.chunks
+		observer.observe(sentinel)
+		if (isNearBottom()) loadNext()
+	})
+})()
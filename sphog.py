@@ -2,4 +2,6 @@
 
 from sphog.app import main
 
-main()
+# image processing workers import this script again (see get_mp_context)
+if __name__ == '__main__':
+    main()
@@ -7,82 +7,121 @@ Implementation of the Album class and its associated helper functions.
 import os
 import os.path
 import re
-import codecs
+import json
 import configparser
-import zipfile
+import threading
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
 
-from PIL import Image, ExifTags
-from jinja2 import  Environment, FileSystemLoader
-from tqdm import tqdm
-
-from .photo import Photo
-from .utils import verbose, error, warn, get_current_path
+from .archive import update_archive
+from .cache import MetadataCache, signature, config_signature
+from .config import read_config
+from .imaging import (
+    _gen_derivatives_task, _gen_thumbnail, get_encoder, allow_huge_images,
+    estimate_memory, _get_min_size
+    )
+from .memory import get_budget, get_max_pixels
+from .output import (
+    get_precompress, get_output_path, write_output,
+    remove_output, publish_file, publish_dir
+    )
+from .photo import Photo, get_generated_prefixes
+from .pipeline import get_pipeline
+from .profiler import profiler, scoped
+from .render import get_template, template_signature
+from .shard import write_summary
+from .sizes import size_report
+from .store import get_store, hash_file, detach
+from .utils import (
+    verbose, error, warn, get_current_path, get_jobs, scan_dir, get_mp_context
+    )
 from .settings import settings
 
+# Files written by the chunked and paginated rendering modes: the manifest
+# listing the JSON chunks of photos, the chunks, and the extra HTML pages
+MANIFEST = 'photos.json'
+CHUNK_NAME = 'photos.{:03d}.json'
+PAGE_NAME = 'page{}.html'
+RENDERED_FILES = r'^(photos(\.\d+)?\.json|page\d+\.html)$'
+
+# Default encoder options of the album thumbnail
+THUMBNAIL_ENCODER = {'quality': 95}
+
 # Python2 does not know about FileNotFoundError, map it if needed
 try:
     FileNotFoundError
 except NameError:
     FileNotFoundError = IOError
 
-def _crop_center(pil_img, crop_width, crop_height):
-    '''Helper function to crop a square image from a rectangle image'''
-    img_width, img_height = pil_img.size
-    return pil_img.crop(((img_width - crop_width) // 2,
-                         (img_height - crop_height) // 2,
-                         (img_width + crop_width) // 2,
-                         (img_height + crop_height) // 2))
-
-def _gen_thumbnail(file_in, file_out, width=450):
+def _get_result(future):
     '''
-    Helper function to generate a square thumbnail from a large picture
+    Returns the result of a derivative generation future, or the error
+    message if the worker process itself failed (e.g. it was killed)
     '''
     try:
-        im = Image.open(file_in)
-        im_thumb = _crop_center(
-            im,
-            min(im.size),
-            min(im.size)
-            ).resize((width, width), Image.LANCZOS)
-        im_thumb.save(file_out, quality=95)
-        return True
-    except FileNotFoundError:
-        error('Could not find thumbnail source [{}]'.format(file_in))
-        return False
-
-
-def _gen_image_copy(path_in, path_out, size):
+        return future.result()
+    except Exception as e:
+        return u'{}'.format(e), None
+
+def _submit(pool, args, tasks, costs=None, budget=None, pipeline=None):
     '''
-    Helper function to generate a smaller version of a photo
-    (e.g. thumbnails, preview)
+    Submits derivative generation tasks to a process pool, and yields
+    (task, result) tuples as they complete. With a memory `budget`, a task
+    is only submitted once its estimated memory (see `costs`) can be
+    reserved. With a `pipeline`, originals are prefetched, and sent to the
+    worker processes along with the task arguments.
     '''
-    thumb = Image.open(path_in)
-    rotation = 0
-    # FIXME: use PIL.Image.Exif instead of private method
-    if thumb._getexif():
-        # extract EXIF metadata and check whether we need to rotate
-        # the output file. PIL does not copy metadata, and we don't
-        # want to lose the orientation.
-        exif = dict((ExifTags.TAGS[k], v) for k, v in thumb._getexif().items() if k in ExifTags.TAGS)
-        if 'Orientation' in exif:
-            o = exif['Orientation']
-            if o == 8: rotation = 90
-            if o == 3: rotation = 180
-            if o == 6: rotation = 270
-            if o in (8, 6):
-                # swap height and width when rotation is 90 or 270
-                rsize = (size[1], size[0])
-                size = rsize
-    if rotation > 0:
-        # Rotate the resized image when needed
-        verbose ('{} needs rotation: {}°'.format(path_in, rotation))
-        thumb = thumb.rotate(rotation, expand=True)
-    # Resize the photo to match the expected size.
-    thumb = thumb.resize(size, Image.ANTIALIAS)
-    thumb.save(path_out)
-    os.chmod(path_out, 0o644)
+    if costs is None:
+        costs = [None] * len(args)
+    if pipeline is None:
+        items = ((a, None) for a in args)
+    else:
+        items = pipeline.prefetch(args)
+    # tasks are pulled one at a time, so that originals are only prefetched
+    # shortly before being submitted
+    queue = zip(items, costs, tasks)
+    item = next(queue, None)
+    futures = {}
+    while item is not None or futures:
+        while item is not None:
+            (a, size), cost, task = item
+            if cost is not None:
+                # only wait for memory when none of our tasks can free it
+                if not budget.acquire(cost, blocking=not futures):
+                    break
+            f = pool.submit(_gen_derivatives_task, a, profiler.enabled)
+            if cost is not None:
+                f.add_done_callback(lambda f, cost=cost: budget.release(cost))
+            if size is not None:
+                f.add_done_callback(lambda f, size=size: pipeline.release(size))
+            futures[f] = task
+            item = next(queue, None)
+        done = wait(futures, return_when=FIRST_COMPLETED)[0]
+        for f in done:
+            yield futures.pop(f), _get_result(f)
 
 
+class Page(object):
+    '''
+    The Page class holds the photos rendered in one HTML page of an album,
+    along with the names of all the pages, to build navigation links.
+    `manifest` is the chunk manifest from which the page loads the photos
+    following its own, if any. Iterating on a Page object yields its photos.
+    '''
+    def __init__(self, number, photos, start, names, manifest=None):
+        self.number   = number
+        self.photos   = photos
+        self.start    = start
+        self.end      = start + len(photos)
+        self.names    = names
+        self.count    = len(names)
+        self.filename = names[number - 1]
+        self.prev     = names[number - 2] if number > 1 else None
+        self.next     = names[number] if number < len(names) else None
+        self.manifest = manifest
+
+    def __iter__(self):
+        return iter(self.photos)
+
 
 class Album(object):
     '''
@@ -91,19 +130,22 @@ class Album(object):
     various paths required to interact with the album. It also implements
     the rendering code, using jinja2 templates.
     '''
-    def __init__(self, site_config, regen=False):
+    def __init__(self, site_config, regen=False, path=None):
         # FIXME: Album config file is hardcoded, but this is a tough one:
         # FIXME: at some point we need a file to hold our properties.
         # FIXME: This might be solved by specifying the path in site_config,
         # FIXME: but this would not be a major improvement
         # FIXME: (and it would need two config reads.)
-        album_config = 'album.def'
+        # All album files are looked up in `path`, which defaults to the
+        # current directory: the album does not depend on the process
+        # working directory, so several albums can be built concurrently.
+        self.path       = os.path.abspath(path or get_current_path())
+        album_config = os.path.join(self.path, 'album.def')
         if not os.path.isfile(album_config):
             raise FileNotFoundError(
                 'E: Could not read {} file'.format(album_config)
                 )
-        config = configparser.ConfigParser()
-        config.read([site_config, album_config], encoding='utf8')
+        config = read_config([site_config, album_config])
         self.config     = config
         self.name       = config.get('album', 'title')
         self.desc       = config.get('album', 'desc')
@@ -119,9 +161,19 @@ class Album(object):
         self.thumbnail_src = config.get('album', 'thumbnail_src', fallback='')
         self.thumbnail_size = config.getint('album', 'thumbnail_size')
         self.photodir   = config.get('album', 'photodir')
+        # generated files are written to `output`, which is `path` unless
+        # the [global] output_root option is set
+        self.output     = get_output_path(config, self.path)
+        # the build state is kept next to the sources, out of the published
+        # tree
+        self.cache      = MetadataCache.open(self._get_path(
+            config.get('album', 'cache_file', fallback='.sphog.cache')
+            ))
+        # set by sharded builds, whose indexes are rendered from the album
+        # summaries (see sphog.shard)
+        self.summary    = False
         self.count      = 0
         self.type       = 'album'
-        self.path       = get_current_path()
         self.base       = u'/{}/'.format(
             self.path.replace(
                 config.get('global', 'siteroot'),
@@ -130,23 +182,140 @@ class Album(object):
             ).replace('//', '/')
         self.url        = self.base
         self.regen      = regen
+        self.jobs       = get_jobs(config)
+        self.progress   = True
+        self.page_size  = config.getint('album', 'page_size', fallback=0)
+        self.chunk_size = config.getint('album', 'chunk_size', fallback=0)
+        # paginated pages hold all their photos, and don't use chunks
+        self.manifest   = MANIFEST if self.chunk_size > 0 and self.page_size <= 0 else None
+        self.precompress = get_precompress(config)
+        self.versioned_urls = config.getboolean(
+            'photos',
+            'versioned_urls',
+            fallback=False
+            )
+        self.encoders   = self._get_encoders()
+        self.store      = get_store(config)
+        self.max_pixels = get_max_pixels(config)
+        self.budget     = get_budget(config)
+        self.pipeline   = get_pipeline(config)
+        if self.max_pixels is not None:
+            allow_huge_images()
         if self.url[-1] == '/': self.url = self.url[:-1]
         try:
             self.parent  = config.get('album', 'parent')
         except configparser.NoOptionError:
             self.parent = self._get_parent()
         self._photos = []
+        self._ordered = True
+        self._desc_mtimes = {}
+        self._sizes = {}
+        self._store_keys = {}
 
     def __iter__(self):
         '''Make the Album objects iterable'''
-        for p in sorted(self._photos, key=lambda p: p.filename):
-            yield p
+        self._order()
+        return iter(self._photos)
 
     def add(self, photo):
-        photo.config = self.config
+        if photo.config is not self.config:
+            photo.config = self.config
         self._photos.append(photo)
+        self._ordered = False
         self.count += 1
 
+    def _order(self):
+        '''
+        Sorts the album photos by filename, once after photos are added, and
+        sets their index, used to look up their neighbours
+        '''
+        if self._ordered:
+            return
+        self._photos.sort(key=lambda p: p.filename)
+        for i, p in enumerate(self._photos):
+            p.index = i
+            p._photos = self._photos
+        self._ordered = True
+
+    def _get_path(self, filename):
+        '''Returns the path of an album file, relative to the album directory'''
+        return os.path.join(self.path, filename)
+
+    def _get_output_path(self, filename):
+        '''Returns the path of a generated album file'''
+        return os.path.join(self.output, filename)
+
+    def _make_output_dirs(self):
+        '''Creates the album directories of the output tree, if needed'''
+        photodir = os.path.normpath(self._get_output_path(self.photodir))
+        if not os.path.isdir(photodir):
+            os.makedirs(photodir)
+
+    def _publish_original(self, photo):
+        '''
+        Makes the original `photo` readable by the web server: it is linked
+        (or copied) to the output tree when output_root is set, otherwise
+        its permissions are fixed, if needed
+        '''
+        if self.output != self.path:
+            photodir = os.path.normpath(self._get_output_path(self.photodir))
+            publish_file(photo.path, os.path.join(photodir, photo.filename))
+        elif os.stat(photo.path).st_mode & 0o444 != 0o444:
+            os.chmod(photo.path, 0o644)
+
+    def _publish_files(self):
+        '''
+        With output_root, publishes the other files of the album directory
+        (e.g. a custom stylesheet), and removes the originals and the
+        derivatives of the photos removed from the album from the output tree
+        '''
+        if self.output == self.path:
+            return
+        publish_dir(self.path, self.output)
+        expected = set([os.path.normpath(self._get_output_path(self.thumbnail))])
+        for p in self._photos:
+            expected.add(os.path.normpath(os.path.join(
+                self._get_output_path(self.photodir),
+                p.filename
+                )))
+            expected.update(
+                os.path.normpath(path) for _, path, _ in self._get_derivatives(p)
+                )
+        generated = '^(%s)'%('|'.join(
+            re.escape(prefix) for prefix in get_generated_prefixes(self.config)
+            ))
+        photodir = os.path.normpath(self._get_output_path(self.photodir))
+        for entry in scan_dir(photodir)[1]:
+            if os.path.normpath(entry.path) in expected:
+                continue
+            if re.match(generated, entry.name) or re.match(r'.*\.jpg$', entry.name, re.I):
+                verbose(u'Removing stale file {}'.format(entry.path))
+                os.remove(entry.path)
+
+    def _get_encoders(self):
+        '''
+        Returns the encoder options of each derivative type, from the
+        encoder profiles named by the thumb_profile, preview_profile,
+        srcset_profile ([photos] section) and thumbnail_profile ([album]
+        section) options
+        '''
+        encoders = {}
+        for kind in ('thumb', 'preview', 'srcset'):
+            encoders[kind] = get_encoder(
+                self.config,
+                self.config.get('photos', kind + '_profile', fallback='')
+                )
+        encoders['thumbnail'] = get_encoder(
+            self.config,
+            self.config.get('album', 'thumbnail_profile', fallback=''),
+            default=THUMBNAIL_ENCODER
+            )
+        return encoders
+
+    def _get_encoder(self, kind):
+        '''Returns the encoder options of a derivative (e.g. srcset_1280_webp)'''
+        return self.encoders[kind.split('_')[0]]
+
     def _get_parent(self):
         '''Returns the path to the parent directory'''
         parent = os.path.abspath(os.path.join(self.path, os.pardir))
@@ -155,87 +324,201 @@ class Album(object):
             re.sub(r'^{}'.format(siteroot), '/', parent)
             ).replace('//', '/')
 
+    @scoped
     def _parse_photodir(self):
-        '''Parses `album.photodir` to find photos'''
+        '''
+        Parses `album.photodir` to find photos. Photo metadata is taken from
+        the album metadata cache when the original file did not change.
+        '''
         # parse album.photodir to find original photos and add them to
         # the object's list
-        for dirname, dirnames, filenames in os.walk(self.photodir):
-            del dirname, dirnames  # unused
-            for f in filenames:
-                if not re.match(r'\.jpg', f[-4:], re.I):
-                    continue
-                thumb   = self.config.get('photos', 'thumb_prefix')
-                preview = self.config.get('photos', 'preview_prefix')
-                if re.match('^(%s|%s)'%(thumb, preview), f):
-                    continue
-                # Only consider photos located directly in photodir,
-                # ignore subdirs
-                if os.path.exists(os.path.join(self.photodir, f)):
-                    self.add(
-                        Photo(
-                            os.path.join(self.photodir, f),
-                            self.config
-                            )
-                        )
-
-    def _zip_files(self):
-        '''Creates a Zip archive from album data'''
-        if os.path.exists(self.archive):
-            if self.regen is False:
-                verbose(
-                    'zip archive {} already created'.format(self.archive)
-                    )
-                return
+        generated = '^(%s)'%('|'.join(
+            re.escape(prefix) for prefix in get_generated_prefixes(self.config)
+            ))
+        filenames = []
+        photodir = os.path.normpath(self._get_path(self.photodir))
+        # Only consider photos located directly in photodir, ignore subdirs
+        with profiler.stage('scan'):
+            files = scan_dir(photodir)[1]
+            # keep track of description files, so they don't need another stat
+            self._desc_mtimes = dict(
+                (entry.path, entry.stat().st_mtime)
+                for entry in files if entry.name.endswith('.desc')
+                )
+        for entry in files:
+            f = entry.name
+            if not re.match(r'\.jpg', f[-4:], re.I):
+                continue
+            if re.match(generated, f):
+                continue
+            stat = entry.stat()
+            meta = self.cache.lookup(f, stat)
+            if meta is None:
+                photo = Photo(entry.path, self.config)
+                self.cache.store(f, stat, photo.meta)
             else:
-                verbose(
-                    'Removing existing zip archive [{}]'.format(self.archive)
-                    )
-                os.remove(self.archive)
-        verbose ('Creating zip archive...')
-        with zipfile.ZipFile(self.archive, 'w') as z:
-            for p in self._photos:
-                z.write(p.path)
-        os.chmod(self.archive, 0o644)
+                photo = Photo(entry.path, self.config, meta=meta)
+            self.add(photo)
+            filenames.append(f)
+        self.cache.prune(filenames)
+        self.cache.save()
 
-    def prepare(self):
+    def _find_photo(self, path):
+        '''Returns the album photo located at `path`, if any'''
+        if path == '':
+            return None
+        path = os.path.normpath(path)
+        for p in self._photos:
+            if p.path == path:
+                return p
+        return None
+
+    def _extract_desc(self, photo):
+        '''Sets the description of `photo`, using the cache when possible'''
+        desc_mtime = self._desc_mtimes.get(photo.desc_path)
+        desc = self.cache.get_desc(photo.filename, desc_mtime)
+        if desc is None:
+            photo._extract_desc()
+            self.cache.set_desc(photo.filename, desc_mtime, photo.desc)
+        else:
+            photo.desc = desc
+
+    def _derivative_state(self, photo, kind, size):
         '''
-        Prepares the album by creating and building the required elements
+        Returns the build state of a derivative of `photo`: a signature of
+        the original photo (size and mtime) and of the derivative parameters
+        '''
+        source = self.cache.get_source(photo.filename)
+        encoder = self._get_encoder(kind)
+        if not encoder:
+            # Pillow defaults: same state as before encoder profiles existed
+            return signature(source, size)
+        return signature(source, size, encoder)
+
+    def _get_derivatives(self, photo):
+        '''
+        Returns the derivatives of `photo`, as a list of (kind, path, size)
+        tuples: thumb, preview and the responsive images ladder
+        '''
+        derivatives = [
+            ('thumb', photo.thumb_path, photo.get_thumb_size()),
+            ('preview', photo.preview_path, photo.get_preview_size()),
+            ]
+        derivatives.extend(
+            (kind, path, size) for kind, path, _, size, _ in photo.get_srcset()
+            )
+        return derivatives
+
+    def _get_derivative_reason(self, photo, kind, path, state):
+        '''
+        Returns why a derivative (e.g. thumb or preview) of `photo` has to be
+        generated: regeneration is forced, it is missing, or it was built
+        from different inputs than the ones described by `state`. Returns
+        None if it is up to date.
+        '''
+        if self.regen is True:
+            return 'forced'
+        if not os.path.exists(path):
+            return 'missing'
+        recorded = self.cache.get_derivative(photo.filename, kind)
+        if recorded is None:
+            # derivative generated before the cache existed: adopt it
+            self.cache.set_derivative(photo.filename, kind, state)
+            return None
+        if recorded != state:
+            return 'outdated'
+        return None
+
+    def _needs_derivative(self, photo, kind, path, state):
+        '''Checks whether a derivative of `photo` has to be generated'''
+        return self._get_derivative_reason(photo, kind, path, state) is not None
+
+    def _thumbnail_state(self, src):
+        '''Returns the build state of the album thumbnail'''
+        try:
+            stat = os.stat(src)
+            source = (stat.st_size, stat.st_mtime)
+        except OSError:
+            source = None
+        encoder = self.encoders['thumbnail']
+        if encoder == THUMBNAIL_ENCODER:
+            return signature(src, source, self.thumbnail_size)
+        return signature(src, source, self.thumbnail_size, encoder)
+
+    def _get_thumbnail_paths(self):
+        '''
+        Returns the paths of the album thumbnail and of its source photo.
+        If no photo has been designated as a source for the album picture,
+        or if it can't be found, the first one that comes is used, so that
+        the recorded thumbnail state matches its actual source.
         '''
-        self._photos = []
-        self.count = 0
-        self._parse_photodir()
-        # now we have the list of original photos, generate thumbnails
-        # and preview, if needed
-        self._photos = sorted(self._photos, key=lambda p: p.filename)
-        # If no photo has been designated as a source for the album picture,
-        # take the first one that comes
         if self.thumbnail_src == '' and len(self._photos) > 0:
+            self._order()
             self.thumbnail_src = self._photos[0].path
-        if not os.path.isfile(self.thumbnail) or self.regen is True:
-            verbose(
-                u'Generating album thumbnail ({})'.format(self.thumbnail)
-                )
-            if _gen_thumbnail(
-                    self.thumbnail_src,
-                    self.thumbnail,
-                    self.thumbnail_size
-                    ):
-                os.chmod(self.thumbnail, 0o644)
-            elif len(self._photos) > 0:
-                warn(u'Using first picture as album thumbnail')
-                if _gen_thumbnail(
-                         self._photos[0].path,
-                         self.thumbnail,
-                         self.thumbnail_size
-                         ):
-                    os.chmod(self.thumbnail, 0o644)
-            else:
-                warn(
-                    'No picture found in album, '
-                    'skipping thumbnail generation'
+        thumb_src = self.thumbnail_src
+        if thumb_src != '':
+            thumb_src = os.path.normpath(self._get_path(thumb_src))
+            if not os.path.isfile(thumb_src) and len(self._photos) > 0:
+                warn(u'Could not find thumbnail source [{}], using first picture'.format(thumb_src))
+                self._order()
+                thumb_src = self._photos[0].path
+        return self._get_output_path(self.thumbnail), thumb_src
+
+    def _get_thumbnail_reason(self, thumbnail, state):
+        '''
+        Returns why the album thumbnail has to be generated: regeneration is
+        forced, it is missing, or its source photo, size or encoder changed.
+        Returns None if it is up to date.
+        '''
+        if self.regen is True:
+            return 'forced'
+        if not os.path.isfile(thumbnail):
+            return 'missing'
+        recorded = self.cache.get_output('thumbnail')
+        if recorded is None:
+            # thumbnail generated before the cache existed: adopt it
+            self.cache.set_output('thumbnail', state)
+            return None
+        if recorded != state:
+            return 'outdated'
+        return None
+
+    def _needs_thumbnail(self, thumbnail, state):
+        '''Checks whether the album thumbnail has to be generated'''
+        return self._get_thumbnail_reason(thumbnail, state) is not None
+
+    @scoped
+    def _zip_files(self):
+        '''Creates or updates a Zip archive from album data'''
+        try:
+            with profiler.stage('zip') as stage:
+                size = update_archive(
+                    self._get_output_path(self.archive),
+                    [
+                        (p.path, os.path.join(self.photodir, p.filename))
+                        for p in self._photos
+                        ],
+                    self.regen
                     )
-        prev = None
-        verbose ('Generating thumbnails and preview images...')
+                stage.add(bytes_read=size)
+        except Exception as e:
+            error(u'Could not build zip archive [{}]: {}'.format(
+                self.archive,
+                e
+                ))
+
+    def _run_tasks(self, tasks, pool=None):
+        '''
+        Generates the derivatives described by `tasks`, a list of
+        (photo, [(kind, path, size, state), ...], square) tuples. Photos are
+        processed by `pool` if provided, otherwise by a pool of `self.jobs`
+        worker processes when more than one job is allowed.
+        A failing photo is reported, and does not abort the album.
+        '''
+        if not tasks:
+            return
+        # tqdm is only needed when there is something to generate
+        from tqdm import tqdm
         barfmt = (
             '    '
             '|{bar}|{percentage:3.0f}% '
@@ -243,41 +526,393 @@ class Album(object):
             '[{elapsed}<{remaining}]'
             )
         progress = tqdm(
-            self._photos,
+            total=len(tasks),
             ncols=80,
             position=0,
             bar_format=barfmt,
             leave=False,
-            disable=settings.quiet
+            disable=settings.quiet or not self.progress
             )
-        for p in progress:
-            os.chmod(p.path, 0o644)
+        args = [
+            (
+                p.path,
+                p.orientation,
+                [(path, size, self._get_encoder(kind)) for kind, path, size, _ in t],
+                s and (s[0], s[1], self.encoders['thumbnail']),
+                self.max_pixels
+                )
+            for p, t, s in tasks
+            ]
+        costs = None
+        if self.budget is not None:
+            # reserve memory for each photo when running in parallel
+            costs = [
+                estimate_memory(
+                    p.path,
+                    (p.width, p.height),
+                    _get_min_size(a[2], a[3]),
+                    self.max_pixels
+                    )
+                for a, (p, _, _) in zip(args, tasks)
+                ]
+        if pool is not None:
+            self._record_results(
+                _submit(pool, args, tasks, costs, self.budget, self.pipeline),
+                progress
+                )
+        elif self.jobs > 1 and len(tasks) > 1:
+            with ProcessPoolExecutor(
+                    max_workers=self.jobs,
+                    mp_context=get_mp_context()
+                    ) as pool:
+                self._record_results(
+                    _submit(pool, args, tasks, costs, self.budget, self.pipeline),
+                    progress
+                    )
+        elif self.pipeline is not None:
+            # prefetch originals and write derivatives in the background
+            self._record_results(self.pipeline.run(args, tasks), progress)
+        else:
+            results = (
+                (task, _gen_derivatives_task(a))
+                for a, task in zip(args, tasks)
+                )
+            self._record_results(results, progress)
+        progress.close()
+
+    def _record_results(self, results, progress):
+        '''Records the state of the derivatives generated by _run_tasks'''
+        for (p, targets, square), (err, stats) in results:
+            progress.update()
+            profiler.merge(stats)
+            if err is not None:
+                error(u'Could not generate derivatives for [{}]: {}'.format(
+                    p.path,
+                    err
+                    ))
+                continue
+            if square:
+                os.chmod(square[0], 0o644)
+                self.cache.set_output('thumbnail', self._thumbnail_state(p.path))
+                self._record_size('thumbnail', square[0])
+            for kind, path, size, state in targets:
+                self.cache.set_derivative(p.filename, kind, state)
+                self._record_size(kind, path)
+                if path in self._store_keys:
+                    self.store.add(
+                        self._store_keys[path],
+                        path,
+                        replace=self.regen is True
+                        )
+
+    def _record_size(self, kind, path):
+        '''Accounts a regenerated derivative to the size report'''
+        if not size_report.enabled:
+            return
+        size_report.record(
+            self.url,
+            kind.split('_')[0],
+            self._get_encoder(kind),
+            self._sizes.get(path),
+            os.path.getsize(path)
+            )
+
+    def _get_hash(self, photo):
+        '''Returns the content hash of `photo`, using the cache when possible'''
+        digest = self.cache.get_hash(photo.filename)
+        if digest is None:
+            digest = hash_file(photo.path)
+            self.cache.set_hash(photo.filename, digest)
+        return digest
+
+    def _fetch_derivatives(self, photo, targets):
+        '''
+        Links the derivatives described by `targets` from the derivative
+        store when it holds them, unless regeneration is forced. Returns the
+        targets which still have to be generated; they will be added to the
+        store once generated.
+        '''
+        try:
+            digest = self._get_hash(photo)
+        except (IOError, OSError) as e:
+            warn(u'Could not hash [{}]: {}'.format(photo.path, e))
+            return targets
+        remaining = []
+        for kind, path, size, state in targets:
+            key = self.store.get_key(digest, path, size, self._get_encoder(kind))
+            if self.regen is not True and self.store.fetch(key, path):
+                self.cache.set_derivative(photo.filename, kind, state)
+            else:
+                self._store_keys[path] = key
+                remaining.append((kind, path, size, state))
+        return remaining
+
+    def _get_previous_size(self, path):
+        '''
+        Remembers the size of a derivative about to be regenerated, for the
+        size report
+        '''
+        if not size_report.enabled:
+            return
+        try:
+            self._sizes[path] = os.path.getsize(path)
+        except OSError:
+            pass
+
+    @scoped
+    def prepare(self, pool=None):
+        '''
+        Prepares the album by creating and building the required elements.
+        Photo derivatives are generated by `pool` (a process pool shared by
+        several albums) when provided.
+        '''
+        self._photos = []
+        self._ordered = True
+        self.count = 0
+        self._sizes = {}
+        self._store_keys = {}
+        self._make_output_dirs()
+        self._parse_photodir()
+        # now we have the list of original photos, generate thumbnails
+        # and preview, if needed
+        self._order()
+        thumbnail, thumb_src = self._get_thumbnail_paths()
+        thumb_state = self._thumbnail_state(thumb_src)
+        thumb_photo = None
+        if self._needs_thumbnail(thumbnail, thumb_state):
+            verbose(
+                u'Generating album thumbnail ({})'.format(self.thumbnail)
+                )
+            # when the source photo is part of the album, the thumbnail is
+            # generated along with the photo derivatives (single decode)
+            thumb_photo = self._find_photo(thumb_src)
+            if thumb_photo is None:
+                self._get_previous_size(thumbnail)
+                if _gen_thumbnail(thumb_src, thumbnail, self.thumbnail_size,
+                                  self.encoders['thumbnail'], self.max_pixels):
+                    os.chmod(thumbnail, 0o644)
+                    self.cache.set_output('thumbnail', thumb_state)
+                    self._record_size('thumbnail', thumbnail)
+                elif len(self._photos) > 0:
+                    warn(u'Using first picture as album thumbnail')
+                    thumb_photo = self._photos[0]
+                else:
+                    warn(
+                        'No picture found in album, '
+                        'skipping thumbnail generation'
+                        )
+        tasks = []
+        for p in self._photos:
+            self._publish_original(p)
             # p._extract_desc(default=self.desc)
-            p._extract_desc()
-            if not os.path.exists(p.thumb_path) or self.regen is True:
-                _gen_image_copy(p.path, p.thumb_path, p.get_thumb_size())
-            if not os.path.exists(p.preview_path) or self.regen is True:
-                _gen_image_copy(p.path, p.preview_path, p.get_preview_size())
-            if prev:
-                prev.next = p
-            p.prev = prev
-            prev = p
-        # Create an archive containing the original photos, if requested
+            self._extract_desc(p)
+            targets = []
+            for kind, path, size in self._get_derivatives(p):
+                state = self._derivative_state(p, kind, size)
+                if self._needs_derivative(p, kind, path, state):
+                    self._get_previous_size(path)
+                    # never write through a link to a store entry
+                    detach(path)
+                    targets.append((kind, path, size, state))
+            if targets and self.store is not None:
+                targets = self._fetch_derivatives(p, targets)
+            square = None
+            if p is thumb_photo:
+                self._get_previous_size(thumbnail)
+                square = (thumbnail, self.thumbnail_size)
+            if targets or square:
+                tasks.append((p, targets, square))
+        # Create an archive containing the original photos, if requested.
+        # This is mostly I/O, so it runs along with the image processing.
+        archiver = None
         if self.archive != '':
-            self._zip_files()
+            archiver = threading.Thread(target=self._zip_files)
+            archiver.start()
+        verbose ('Generating thumbnails and preview images...')
+        self._run_tasks(tasks, pool)
+        self._publish_files()
+        self.cache.save()
+        if archiver is not None:
+            archiver.join()
+
+    def _render_state(self):
+        '''
+        Returns the build state of the album index: a signature of the
+        template, of the album configuration and of the photos data
+        '''
+        photos = [
+            (p.filename, p.desc, p.width, p.height,
+             p.get_thumb_size(), p.get_preview_size(), p.srcset)
+            for p in self
+            ]
+        if self.versioned_urls:
+            photos.extend(p.versions or {} for p in self)
+        return signature(
+            template_signature(self.config, self.template),
+            config_signature(self.config),
+            self.path,
+            photos
+            )
+
+    def _get_pages(self, output_file):
+        '''
+        Splits the album photos into pages: `page_size` photos per HTML page
+        when pagination is enabled. Otherwise, a single page holds either
+        all the photos, or the first chunk only, when the remaining photos
+        are loaded on demand from JSON chunks.
+        '''
+        photos = list(self)
+        size = self.page_size
+        # paginated pages hold all their photos: only a single page loads
+        # the following ones from the chunks
+        manifest = None
+        if size <= 0:
+            size = self.chunk_size if self.manifest is not None else len(photos)
+            photos = photos[:size]
+            manifest = self.manifest
+        size = max(size, 1)
+        starts = range(0, max(len(photos), 1), size)
+        names = [output_file] + [PAGE_NAME.format(n + 1) for n in range(1, len(starts))]
+        return [
+            Page(n + 1, photos[start:start + size], start, names, manifest)
+            for n, start in enumerate(starts)
+            ]
+
+    def _get_entry(self, photo):
+        '''Returns the compact description of a photo, used in JSON chunks'''
+        return {
+            'href': photo.href,
+            'width': photo.width,
+            'height': photo.height,
+            'thumb': photo.thumb,
+            'thumb_width': photo.thumb_width,
+            'thumb_height': photo.thumb_height,
+            'srcset': photo.get_srcset_string(),
+            'desc': photo.desc or '',
+            }
 
+    def _get_chunks(self):
+        '''
+        Returns the JSON chunks of the album, as a list of (filename, start,
+        photos) tuples, or an empty list if chunks are disabled or unused
+        (paginated albums)
+        '''
+        if self.manifest is None:
+            return []
+        photos = list(self)
+        return [
+            (CHUNK_NAME.format(n + 1), start, photos[start:start + self.chunk_size])
+            for n, start in enumerate(range(0, len(photos), self.chunk_size))
+            ]
+
+    def _write_json(self, filename, data):
+        '''Writes `data` as compact JSON to an album file, returns its size'''
+        return write_output(
+            self._get_output_path(filename),
+            json.dumps(data, separators=(',', ':'), ensure_ascii=False),
+            self.precompress
+            )
+
+    def _remove_stale(self, filenames):
+        '''Removes the pages and chunks left over by a previous render'''
+        for entry in scan_dir(self.output)[1]:
+            if (re.match(RENDERED_FILES, entry.name)
+                    and entry.name not in filenames):
+                verbose(u'Removing stale file {}'.format(entry.name))
+                remove_output(entry.path)
+
+    def _set_versions(self, photo):
+        '''Versions the derivative URLs of `photo` with their build state'''
+        versions = {}
+        for kind, _, _ in self._get_derivatives(photo):
+            state = self.cache.get_derivative(photo.filename, kind)
+            if state is not None:
+                versions[kind] = state
+        photo.set_versions(versions)
+
+    def _get_rendered_files(self, pages, chunks):
+        '''Returns the names of the files written by render()'''
+        filenames = [page.filename for page in pages]
+        if chunks:
+            filenames.append(MANIFEST)
+            filenames.extend(chunk[0] for chunk in chunks)
+        return filenames
+
+    def _get_render_reason(self, name, state, filenames):
+        '''
+        Returns why the album index has to be rendered: regeneration is
+        forced, one of its files is missing, or its inputs changed. Returns
+        None if it is up to date.
+        '''
+        if self.regen is True:
+            return 'forced'
+        if not all(os.path.isfile(self._get_output_path(f)) for f in filenames):
+            return 'missing'
+        if self.cache.get_output(name) != state:
+            return 'outdated'
+        return None
+
+    @scoped
     def render(self, output_file='index.html'):
         '''
-        Renders current album using the appropriate template.
+        Renders current album using the appropriate template. Rendering is
+        skipped when the template, the album configuration and the photos
+        did not change since the last run.
+
+        Large albums can be split into several HTML pages (`page_size`), and
+        their photo list written as JSON chunks (`chunk_size`), listed by a
+        manifest: pages then only embed their first photos, and templates
+        can load the remaining ones on demand.
+
+        In sharded builds, the album summary used by merge builds (see
+        sphog.shard) is written along with the pages.
         FIXME: Output file is hardcoded to index.html, maybe this should change
         '''
-        env = Environment(
-            loader=FileSystemLoader(
-                searchpath=self.config.get('global', 'templatedir')
-                )
-            )
-        template = env.get_template(self.template)
-        with codecs.open(output_file, 'wb', 'utf8') as out:
-            tmp_output = template.render(album=self)
-            out.write(tmp_output)
-        os.chmod(output_file, 0o644)
+        for p in self._photos:
+            if p.desc is None:
+                self._extract_desc(p)
+            if self.versioned_urls:
+                self._set_versions(p)
+        state = self._render_state()
+        name = output_file
+        pages = self._get_pages(output_file)
+        chunks = self._get_chunks()
+        filenames = self._get_rendered_files(pages, chunks)
+        if self._get_render_reason(name, state, filenames) is None:
+            verbose(u'{} is up to date'.format(self._get_output_path(output_file)))
+            if self.summary:
+                write_summary(self)
+            self.cache.save()
+            return
+        self._make_output_dirs()
+        template = get_template(self.config, self.template)
+        with profiler.stage('render') as stage:
+            for page in pages:
+                for p in page:
+                    p.page = page.number
+                tmp_output = template.render(album=self, page=page)
+                stage.add(bytes_written=write_output(
+                    self._get_output_path(page.filename),
+                    tmp_output,
+                    self.precompress
+                    ))
+            if chunks:
+                manifest = {
+                    'count': self.count,
+                    'chunks': [
+                        {'url': f, 'start': start, 'count': len(photos)}
+                        for f, start, photos in chunks
+                        ],
+                    }
+                size = self._write_json(MANIFEST, manifest)
+                for f, start, photos in chunks:
+                    size += self._write_json(
+                        f,
+                        [self._get_entry(p) for p in photos]
+                        )
+                stage.add(bytes_written=size)
+        self._remove_stale(filenames)
+        if self.summary:
+            write_summary(self)
+        self.cache.set_output(name, state)
+        self.cache.save()
@@ -1,13 +1,15 @@
 import os
 import os.path
 import re
-import configparser
-import codecs
-
-from jinja2 import  Environment, FileSystemLoader
 
 from .album import Album
-from .utils import get_current_path, info, warn
+from .cache import MetadataCache, signature, config_signature
+from .output import get_precompress, get_output_path, write_output, publish_dir
+from .config import read_config
+from .profiler import profiler, scoped
+from .render import get_template, template_signature
+from .shard import AlbumSummary, in_shard
+from .utils import get_current_path, scan_dir, verbose, warn
 
 # Python2 does not know about FileNotFoundError, map it if needed
 try:
@@ -16,16 +18,23 @@ except NameError:
     FileNotFoundError = IOError
 
 class AlbumSet(object):
-    def __init__(self, site_config, recurse=False, build_albums=False, regen=False):
-        dir_config = 'index.def'
+    def __init__(self, site_config, recurse=False, build_albums=False, regen=False, path=None, shard=None, merge=False):
+        # All files are looked up in `path` (default: the current directory),
+        # the process working directory is never changed.
+        # With a `shard` ((i, N) tuple), only the albums of this shard are
+        # considered. With `merge`, albums are represented by the summaries
+        # written by their builds, and their photos are not read.
+        self.path          = os.path.abspath(path or get_current_path())
+        dir_config = os.path.join(self.path, 'index.def')
         if not os.path.isfile(dir_config):
             raise FileNotFoundError('E: Could not read {} file'.format(dir_config))
-        config = configparser.ConfigParser()
-        config.read([site_config, dir_config], encoding='utf8')
+        config = read_config([site_config, dir_config])
         self.config        = config
         self._recurse      = recurse
         self._build_albums = build_albums
         self.regen         = regen
+        self._shard        = shard
+        self._merge        = merge
         self.name          = config.get('directory', 'title')
         self.desc          = config.get('directory', 'desc')
         self.stylesheet    = config.get('directory', 'stylesheet')
@@ -34,7 +43,11 @@ class AlbumSet(object):
         self.exclude       = self._parse_list(config.get('directory', 'exclude', fallback=''))
         self.order         = self._parse_list(config.get('directory', 'order', fallback=''))
         self.type          = 'albumset'
-        self.path          = get_current_path()
+        self.output        = get_output_path(config, self.path)
+        self.cache         = MetadataCache.open(os.path.join(
+            self.path,
+            config.get('directory', 'cache_file', fallback='.sphog.cache')
+            ))
         self.url = u'{}'.format(re.sub(r'^{}'.format(self.config.get('global', 'siteroot')), '/', self.path)).replace('//', '/')
         if self.url[-1] == '/': self.url = self.url[:-1]
         self.parent        = self._get_parent()
@@ -79,59 +92,99 @@ class AlbumSet(object):
         return destlist
 
     def _get_children(self, site_config):
+        '''
+        Scans the album set directory to find albums and nested album sets.
+        Nothing is built here: see sphog.builder for that.
+        '''
         self.children = []
-        curpath = get_current_path()
-        for (dirpath, dirs, files) in os.walk(self.path):
-            # only walk the current directory, skip the subdirs
-            if dirpath != curpath:
+        with profiler.scope(self.url), profiler.stage('scan'):
+            dirs = scan_dir(self.path)[0]
+        for entry in dirs:
+            d = entry.name
+            if d in self.exclude:
                 continue
-            for d in dirs:
-                if d in self.exclude:
+            path = entry.path
+            if os.path.exists(os.path.join(path, 'album.def')):
+                if not in_shard(self.config, path, self._shard):
                     continue
-                if os.path.exists(os.path.join(d, 'album.def')):
-                    # craft Album object here
-                    os.chdir(d)
-                    try:
-                        album = Album(site_config, self.regen)
-                        album._parse_photodir()
-                        if self.regen and not self._build_albums:
-                            info (u'Building album index [{}]'.format(album.base))
-                            album.render()
-                        if self._build_albums:
-                            info (u'Building album [{}]'.format(album.base))
-                            album.prepare()
-                            album.render()
-                        self.children.append(album)
-                    except Exception as e:
-                        warn(u'something went wrong when building album in {}:\n{}'.format(d, e))
-                    os.chdir(self.path)
-                elif os.path.exists(os.path.join(d, 'index.def')):
-                    # craft AlbumSet object here
-                    os.chdir(d)
+                if self._merge:
                     try:
-                        # don't build nested albums if recurse is disabled
-                        build_albums = self._recurse and self._build_albums
-                        album_set = AlbumSet(site_config, self._recurse, build_albums, self.regen)
-                        if self._recurse:
-                            info (u'Building directory index [{}]'.format(album_set.url))
-                            album_set.render()
-                        self.children.append(album_set)
-                    except Exception as e: 
-                        warn (u'something went wrong when building album set in {}\n{}'.format(d, e))
-                    os.chdir(self.path)
-                    pass
-                else:
-                    # do nothing
-                    pass
+                        self.children.append(AlbumSummary.load(self.config, path))
+                    except (IOError, OSError, ValueError) as e:
+                        warn(u'No summary found for album in {}, skipping it: {}'.format(d, e))
+                    continue
+                # craft Album object here
+                try:
+                    album = Album(site_config, self.regen, path=path)
+                    album.summary = self._shard is not None
+                    album._parse_photodir()
+                    self.children.append(album)
+                except Exception as e:
+                    warn(u'something went wrong when building album in {}:\n{}'.format(d, e))
+            elif os.path.exists(os.path.join(path, 'index.def')):
+                # craft AlbumSet object here
+                try:
+                    # don't build nested albums if recurse is disabled
+                    build_albums = self._recurse and self._build_albums
+                    album_set = AlbumSet(site_config, self._recurse, build_albums, self.regen, path=path, shard=self._shard, merge=self._merge)
+                    self.children.append(album_set)
+                except Exception as e: 
+                    warn (u'something went wrong when building album set in {}\n{}'.format(d, e))
+            else:
+                # do nothing
+                pass
         return self._sort_children()
 
-    '''Render current album set using the appropriate template.'''
-    def render(self, output_file='index.html'):
-        env = Environment(loader=FileSystemLoader(searchpath=self.config.get('global', 'templatedir')))
-        template = env.get_template(self.template)
-        out = codecs.open(output_file, 'wb', 'utf8')
-        tmp_output = template.render(directory=self)
-        out.write(tmp_output)
-        out.close()
-        os.chmod(output_file, 0o644)
+    def _render_state(self):
+        '''
+        Returns the build state of the index: a signature of the template, of
+        the index configuration and of the children data used by templates
+        '''
+        children = [
+            (c.type, c.url, c.name, c.desc, getattr(c, 'index_desc', None),
+             getattr(c, 'date', None), getattr(c, 'count', None), c.thumbnail)
+            for c in self.children
+            ]
+        return signature(template_signature(self.config, self.template), config_signature(self.config), self.path, children)
+
+    def _publish_files(self):
+        '''
+        With output_root, publishes the files of the album set directory
+        (e.g. its thumbnail), and its subdirectories which are neither
+        albums nor album sets (e.g. stylesheets and scripts)
+        '''
+        if self.output == self.path:
+            return
+        exclude = list(self.exclude)
+        for entry in scan_dir(self.path)[0]:
+            if (os.path.exists(os.path.join(entry.path, 'album.def'))
+                    or os.path.exists(os.path.join(entry.path, 'index.def'))):
+                exclude.append(entry.name)
+        publish_dir(self.path, self.output, True, exclude)
 
+    '''
+    Render current album set using the appropriate template. Rendering is
+    skipped when the template, the configuration and the children did not
+    change since the last run.
+    '''
+    @scoped
+    def render(self, output_file='index.html'):
+        self._publish_files()
+        state = self._render_state()
+        name = output_file
+        output_file = os.path.join(self.output, output_file)
+        if not self.regen and os.path.isfile(output_file) and self.cache.get_output(name) == state:
+            verbose(u'{} is up to date'.format(output_file))
+            return
+        if not os.path.isdir(self.output):
+            os.makedirs(self.output)
+        template = get_template(self.config, self.template)
+        with profiler.stage('render') as stage:
+            tmp_output = template.render(directory=self)
+            stage.add(bytes_written=write_output(
+                output_file,
+                tmp_output,
+                get_precompress(self.config)
+                ))
+        self.cache.set_output(name, state)
+        self.cache.save()
@@ -20,18 +20,19 @@ this program. If not, see <http://www.gnu.org/licenses/>.
 
 from __future__ import print_function
 
-import os, sys, re, os.path, codecs
-import zipfile
-import configparser
+import os, sys, os.path, codecs
+import json
 import argparse
 
-from PIL import Image
-from jinja2 import  Environment, FileSystemLoader
-
-from .album import Album
-from .albumset import AlbumSet
-from .utils import info, get_current_path
+# The album, album set, builder, planner and watch modules are imported by
+# the functions using them, so that --help does not load them. Pillow,
+# jinja2 and tqdm are only loaded once there is something to generate.
+from .config import read_config
+from .profiler import profiler
+from .utils import info, error, get_current_path, get_jobs
 from .settings import settings
+from .shard import parse_shard
+from .sizes import size_report
 
 # Python2 does not know about FileNotFoundError, map it if needed
 try:
@@ -103,7 +104,28 @@ def build_album_def():
     with codecs.open('album.def', 'wb', 'utf8') as out:
         out.write(base_template.format(**answers))
 
+def print_plan(site_config, recurse=False, build_albums=False, regen=False, output='text', shard=None, merge=False):
+    '''
+    Prints the plan of the build of the current album or index, without
+    building (or writing) anything
+    '''
+    from .album import Album
+    from .albumset import AlbumSet
+    from .plan import make_plan, format_plan
+    settings.dry_run = True
+    if os.path.exists('index.def'):
+        root = AlbumSet(site_config, recurse, build_albums, regen, shard=shard, merge=merge)
+    else:
+        root = Album(site_config, regen)
+        root._parse_photodir()
+    plan = make_plan(root, get_jobs(root.config))
+    if output == 'json':
+        print (json.dumps(plan, indent=2, sort_keys=True))
+    else:
+        print (format_plan(plan))
+
 def build_album(site_config, regen=False, interactive=False):
+    from .album import Album
     try:
         album = Album(site_config, regen)
         info ('Building album [{}]'.format(album.base))
@@ -119,9 +141,16 @@ def build_album(site_config, regen=False, interactive=False):
     except:
         raise
 
-def build_index(site_config, recurse=False, build_albums=False, regen=False, interactive=False):
+def build_index(site_config, recurse=False, build_albums=False, regen=False, interactive=False, shard=None, merge=False):
+    from .albumset import AlbumSet
+    from .builder import TreeBuilder
     try:
-        albumset = AlbumSet(site_config, recurse, build_albums, regen)
+        albumset = AlbumSet(site_config, recurse, build_albums, regen, shard=shard, merge=merge)
+        TreeBuilder(get_jobs(albumset.config)).build(albumset)
+        if shard is not None:
+            # indexes are rendered by the merge build (--merge)
+            info ('Built shard {}/{} of [{}]'.format(shard[0], shard[1], albumset.url or '/'))
+            return
         info ('Building directory index [{}]'.format(albumset.url))
         # FIXME: add option to specify output file name
         # albumset.render(output_file='index.test.html')
@@ -138,6 +167,13 @@ def build_index(site_config, recurse=False, build_albums=False, regen=False, int
 
 
 
+def shard_type(value):
+    '''argparse type of the --shard option'''
+    try:
+        return parse_shard(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
 #if __name__ == '__main__':
 
 def main():
@@ -148,9 +184,24 @@ def main():
     parser.add_argument('-r', '--recurse', action='store_true', help='Generate index files and albums for the entire subtree')
     parser.add_argument('-b', '--build-albums', action='store_true', help='Generate album files in the directory set')
     parser.add_argument('-f', '--force-regen', action='store_true', help='Force the regeneration of all album data')
+    parser.add_argument('-j', '--jobs', type=int, metavar='N', help='Number of parallel jobs used to build albums and images (0: one per CPU core)')
+    parser.add_argument('-w', '--watch', action='store_true', help='Keep running, and rebuild albums and indexes when their content changes')
+    parser.add_argument('--profile', metavar='FILE', help='Write a JSON report of the time spent in each build stage to FILE')
+    parser.add_argument('--size-report', metavar='FILE', help='Write a JSON report of the size of regenerated derivatives, compared with their previous version, to FILE')
+    parser.add_argument('--shard', type=shard_type, metavar='i/N', help='Only build the albums of shard i (1 to N) of the tree, without rendering indexes (use with -r -b)')
+    parser.add_argument('--merge', action='store_true', help='Only render the indexes of the tree, from the album summaries written by sharded builds')
+    parser.add_argument('--plan', nargs='?', const='text', choices=('text', 'json'), help='Only print what would be built, and why, with cost estimates (as text or JSON)')
     args = parser.parse_args()
+    if (args.shard is not None or args.merge) and not os.path.exists('index.def'):
+        # a single album can't be split across shards
+        parser.error('--shard and --merge can only be used in an album set (index.def) directory')
     settings.verbose = args.verbose
     settings.quiet = args.quiet
+    settings.jobs = args.jobs
+    if args.profile:
+        profiler.start()
+    if args.size_report:
+        size_report.start()
 
     # Read the site config in the script main directory, and the album config in the current directory
     # The site config provides default values. All parameters can be overriden by the album config.
@@ -159,13 +210,37 @@ def main():
     site_config = os.path.join(os.path.dirname(sys.argv[0]), 'site.config')
 
 
+    if args.plan:
+        print_plan(site_config, recurse=args.recurse or args.merge, build_albums=args.build_albums and not args.merge, regen=args.force_regen, output=args.plan, shard=args.shard, merge=args.merge)
+        return
+
     # try generating an index first
     if os.path.exists('index.def'):
-        build_index(site_config, recurse=args.recurse, build_albums=args.build_albums, regen=args.force_regen)
-        sys.exit(0)
-
+        build_index(site_config, recurse=args.recurse or args.merge, build_albums=args.build_albums and not args.merge, regen=args.force_regen, shard=args.shard, merge=args.merge)
     # otherwise, deal with the album or index if there is one
-    if os.path.exists('photos'):
+    elif os.path.exists('photos'):
         build_album(site_config, regen=args.force_regen, interactive=True)
     else:
         build_index(site_config, interactive=True)
+
+    if args.profile:
+        profiler.write(args.profile)
+        info ('Profiling report written to {}'.format(args.profile))
+    if args.size_report:
+        size_report.print_summary()
+        size_report.write(args.size_report)
+        info ('Size report written to {}'.format(args.size_report))
+
+    if args.watch:
+        from .watch import watch
+        config = read_config([site_config])
+        watch(
+            site_config,
+            get_current_path(),
+            interval=config.getfloat('global', 'watch_interval', fallback=2.0),
+            debounce=config.getfloat('global', 'watch_debounce', fallback=1.0),
+            recurse=args.recurse or args.merge,
+            build_albums=args.build_albums and not args.merge,
+            shard=args.shard,
+            merge=args.merge
+            )
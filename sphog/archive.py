@@ -0,0 +1,150 @@
+# encoding: utf-8
+
+'''
+Implementation of the incremental zip archive builder used by albums.
+'''
+
+import os
+import os.path
+import shutil
+import filecmp
+import zipfile
+
+from .utils import verbose, warn
+
+# Size of the chunks used to stream files into archives
+CHUNK_SIZE = 1024 * 1024
+# Files which are already compressed, and stored as is
+STORED_EXTENSIONS = ('.jpg', '.jpeg')
+
+
+def _get_info(path, arcname):
+    '''Returns the ZipInfo object describing a file to be archived'''
+    info = zipfile.ZipInfo.from_file(path, arcname, strict_timestamps=False)
+    if arcname.lower().endswith(STORED_EXTENSIONS):
+        info.compress_type = zipfile.ZIP_STORED
+    else:
+        info.compress_type = zipfile.ZIP_DEFLATED
+    return info
+
+def _is_changed(info, path, arcname):
+    '''
+    Checks whether an archive entry is outdated. Zip timestamps have a two
+    seconds resolution, which is taken into account.
+    '''
+    current = _get_info(path, arcname)
+    date_time = current.date_time[0:5] + (current.date_time[5] // 2 * 2,)
+    return info.file_size != current.file_size or info.date_time != date_time
+
+def _add_file(z, path, arcname):
+    '''
+    Streams a file into an opened archive, in bounded memory. Returns the
+    number of bytes read.
+    '''
+    info = _get_info(path, arcname)
+    with open(path, 'rb') as src, z.open(info, 'w', force_zip64=True) as dest:
+        shutil.copyfileobj(src, dest, CHUNK_SIZE)
+    return info.file_size
+
+def _get_changes(archive, files):
+    '''
+    Compares the content of an existing archive with `files`. Returns the
+    list of files to append, or None if the archive has to be rebuilt
+    because some entries were removed or changed.
+    '''
+    with zipfile.ZipFile(archive, 'r') as z:
+        entries = dict((info.filename, info) for info in z.infolist())
+    added = []
+    for path, arcname in files:
+        info = entries.pop(arcname, None)
+        if info is None:
+            added.append((path, arcname))
+            continue
+        if _is_changed(info, path, arcname):
+            verbose(u'{} changed in zip archive'.format(arcname))
+            return None
+    if len(entries) > 0:
+        verbose(u'{} entries removed from zip archive'.format(len(entries)))
+        return None
+    return added
+
+def plan_archive(archive, files, regen=False):
+    '''
+    Returns what update_archive() has to do, without writing anything, as
+    an (action, reason, files) tuple: `action` is None when the archive is
+    up to date, 'append' or 'rebuild', and `files` the list of (path,
+    arcname) tuples to write.
+    '''
+    if regen is True:
+        return 'rebuild', 'forced', files
+    if not os.path.exists(archive):
+        return 'rebuild', 'missing', files
+    try:
+        added = _get_changes(archive, files)
+    except (zipfile.BadZipfile, IOError, OSError) as e:
+        warn(u'Rebuilding unreadable zip archive [{}]: {}'.format(archive, e))
+        return 'rebuild', 'unreadable', files
+    if added is None:
+        return 'rebuild', 'entries removed or changed', files
+    if len(added) == 0:
+        return None, None, []
+    return 'append', u'{} new photos'.format(len(added)), added
+
+def _append(archive, added):
+    '''
+    Appends `added` files to `archive` in place: the new entries and the
+    central directory are written over the previous central directory,
+    which is saved first, and written back if appending fails, so that
+    the previous archive is restored. Returns the number of bytes added.
+    '''
+    with open(archive, 'rb') as f:
+        with zipfile.ZipFile(f) as z:
+            start = z.start_dir
+        f.seek(start)
+        directory = f.read()
+    try:
+        with zipfile.ZipFile(archive, 'a', allowZip64=True) as z:
+            return sum(_add_file(z, path, arcname) for path, arcname in added)
+    except BaseException:
+        with open(archive, 'r+b') as f:
+            f.seek(start)
+            f.write(directory)
+            f.truncate()
+        raise
+
+def update_archive(archive, files, regen=False):
+    '''
+    Updates the zip `archive` so that it holds `files`, a list of
+    (path, arcname) tuples. New files are appended to an existing archive,
+    which is restored if appending fails (see _append); it is only rebuilt
+    when entries were removed or changed, or if `regen` is set. Rebuilt
+    archives are written to a temporary file, which then replaces the
+    previous one, so a complete archive is always available. The previous
+    archive is kept when it is identical to the rebuilt one. Returns the
+    number of bytes added to the archive.
+    '''
+    action, reason, added = plan_archive(archive, files, regen)
+    if action is None:
+        verbose(u'zip archive {} is up to date'.format(archive))
+        return 0
+    if action == 'append':
+        # Appending only writes the new entries. If the process is killed
+        # while appending, the archive can not be read anymore, and it is
+        # rebuilt during the next run.
+        verbose(u'Adding {} photos to zip archive...'.format(len(added)))
+        return _append(archive, added)
+    verbose(u'Creating zip archive ({})...'.format(reason))
+    tmp_archive = u'{}.tmp'.format(archive)
+    try:
+        with zipfile.ZipFile(tmp_archive, 'w', allowZip64=True) as z:
+            size = sum(_add_file(z, path, arcname) for path, arcname in files)
+        if (os.path.isfile(archive)
+                and filecmp.cmp(tmp_archive, archive, shallow=False)):
+            verbose(u'zip archive {} did not change'.format(archive))
+            return 0
+        os.chmod(tmp_archive, 0o644)
+        os.replace(tmp_archive, archive)
+        return size
+    finally:
+        if os.path.exists(tmp_archive):
+            os.remove(tmp_archive)
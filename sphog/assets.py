@@ -0,0 +1,209 @@
+# encoding: utf-8
+
+'''
+Implementation of the static assets pipeline: the stylesheets, scripts and
+images of the [global] `assetdir` directory are copied to the site root
+with content-hashed filenames (e.g. /css/index.1a2b3c4d5e.css), so that
+they can be served with far-future cache headers. Templates get the hashed
+URL of an asset with the asset() function.
+'''
+
+import os
+import os.path
+import re
+import json
+import shutil
+import hashlib
+import posixpath
+import threading
+
+from .cache import signature
+from .output import get_precompress, get_output_path, write_output
+from .settings import settings
+from .utils import verbose
+
+# Number of hexadecimal digits of the content hash in filenames
+HASH_LENGTH = 10
+# Assets handled as text: CSS urls are rewritten, and text assets get
+# precompressed variants
+TEXT_EXTENSIONS = ('.css', '.js', '.svg')
+CSS_URL = re.compile(r'''url\(\s*(['"]?)([^'")]+)\1\s*\)''')
+# Manifest listing the hashed URL of each asset, written to the site root
+MANIFEST = 'assets.json'
+
+# Published assets, indexed by asset configuration, see get_assets()
+_assets = {}
+_lock = threading.Lock()
+
+
+def get_assets_key(config):
+    '''Returns the asset settings of `config`, as a hashable tuple'''
+    dirs = config.get('global', 'assets', fallback='css, js, images')
+    return (
+        config.get('global', 'assetdir', fallback=''),
+        get_output_path(config, config.get('global', 'siteroot')),
+        tuple(d.strip() for d in dirs.split(',') if d.strip() != ''),
+        get_precompress(config),
+        )
+
+def _scan(assetdir, dirs):
+    '''
+    Returns the assets found in the `dirs` subdirectories of `assetdir`, as
+    a dict mapping their URL to their (path, size, mtime)
+    '''
+    files = {}
+    for d in dirs:
+        for dirpath, _, filenames in os.walk(os.path.join(assetdir, d)):
+            for f in filenames:
+                path = os.path.join(dirpath, f)
+                stat = os.stat(path)
+                url = '/' + os.path.relpath(path, assetdir).replace(os.sep, '/')
+                files[url] = (path, stat.st_size, stat.st_mtime)
+    return files
+
+def _hashed_url(url, data):
+    '''Returns the content-hashed version of `url`'''
+    digest = hashlib.sha1(data).hexdigest()[:HASH_LENGTH]
+    stem, ext = posixpath.splitext(url)
+    return u'{}.{}{}'.format(stem, digest, ext)
+
+
+class Assets(object):
+    '''
+    The Assets class publishes the assets of a site, and maps their URLs to
+    their content-hashed versions. Unknown URLs are returned unchanged.
+    '''
+    def __init__(self, assetdir, siteroot, dirs, precompress=False):
+        self.assetdir    = assetdir
+        self.siteroot    = siteroot
+        self.dirs        = dirs
+        self.precompress = precompress
+        self.urls        = {}
+        self.signature   = None
+        self._files      = _scan(assetdir, dirs)
+
+    def url(self, url):
+        '''Returns the content-hashed URL of the asset `url`'''
+        return self.urls.get(url, url)
+
+    def is_stale(self):
+        '''Checks whether assets changed since they were published'''
+        return _scan(self.assetdir, self.dirs) != self._files
+
+    def publish(self):
+        '''
+        Copies the assets to the site root, with content-hashed filenames.
+        Stylesheets are processed last, as their urls are rewritten to the
+        hashed URLs of the assets they reference. Existing files are kept.
+        '''
+        for url in sorted(self._files):
+            if not url.endswith('.css'):
+                self._publish(url)
+        for url in sorted(self._files):
+            if url.endswith('.css'):
+                self._publish_css(url, set())
+        self.signature = signature(sorted(self.urls.items()))
+        if not settings.dry_run:
+            if not os.path.isdir(self.siteroot):
+                os.makedirs(self.siteroot)
+            write_output(
+                os.path.join(self.siteroot, MANIFEST),
+                json.dumps(self.urls, indent=2, sort_keys=True),
+                self.precompress
+                )
+
+    def _publish_css(self, url, visiting):
+        '''Publishes a stylesheet, after the stylesheets it imports'''
+        if url in self.urls or url in visiting:
+            return
+        visiting.add(url)
+        def replace(match):
+            target = match.group(2)
+            if re.match(r'^([a-z]+:|//|#)', target):
+                return match.group(0)
+            if not target.startswith('/'):
+                target = posixpath.normpath(
+                    posixpath.join(posixpath.dirname(url), target)
+                    )
+            if target.endswith('.css') and target in self._files:
+                self._publish_css(target, visiting)
+            if target not in self.urls:
+                return match.group(0)
+            return u'url({0}{1}{0})'.format(match.group(1), self.urls[target])
+        with open(self._files[url][0], 'rb') as f:
+            content = f.read().decode('utf8')
+        self._publish(url, CSS_URL.sub(replace, content).encode('utf8'))
+
+    def _publish(self, url, data=None):
+        '''Copies an asset (or writes its `data`) with a hashed filename'''
+        path = self._files[url][0]
+        if data is None:
+            with open(path, 'rb') as f:
+                data = f.read()
+        hashed = _hashed_url(url, data)
+        self.urls[url] = hashed
+        if settings.dry_run:
+            return
+        output = os.path.join(self.siteroot, *hashed.lstrip('/').split('/'))
+        if not os.path.isdir(os.path.dirname(output)):
+            os.makedirs(os.path.dirname(output))
+        if url.endswith(TEXT_EXTENSIONS):
+            write_output(output, data.decode('utf8'), self.precompress)
+        elif not os.path.isfile(output):
+            verbose(u'Publishing asset {}'.format(hashed))
+            shutil.copyfile(path, output)
+            os.chmod(output, 0o644)
+
+
+def get_assets(config):
+    '''
+    Returns the Assets of the site described by `config`, or None if the
+    [global] assetdir option is not set. Assets are scanned and published
+    once per process, and again after refresh_assets() found changes (e.g.
+    in watch mode).
+    '''
+    key = get_assets_key(config)
+    if key[0] == '':
+        return None
+    with _lock:
+        assets = _assets.get(key)
+        if assets is None:
+            assets = Assets(*key)
+            assets.publish()
+            _assets[key] = assets
+    return assets
+
+def refresh_assets():
+    '''
+    Forgets the published assets which changed since they were published,
+    so that the next get_assets() call publishes them again
+    '''
+    with _lock:
+        for key, assets in list(_assets.items()):
+            if assets.is_stale():
+                del _assets[key]
+
+def get_asset_lookup(config):
+    '''
+    Returns the asset() function exposed to templates: it maps the URL of an
+    asset to its content-hashed URL, or returns it unchanged
+    '''
+    key = get_assets_key(config)
+    def asset(url):
+        # assets are published before rendering, when computing the
+        # template signature: don't look them up again for each URL
+        with _lock:
+            assets = _assets.get(key)
+        if assets is None:
+            assets = get_assets(config)
+        if assets is None:
+            return url
+        return assets.url(url)
+    return asset
+
+def assets_signature(config):
+    '''Returns a signature of the site assets, or None if there are none'''
+    assets = get_assets(config)
+    if assets is None:
+        return None
+    return assets.signature
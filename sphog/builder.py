@@ -0,0 +1,124 @@
+# encoding: utf-8
+
+'''
+Implementation of the tree builder, which builds the albums and indexes
+found in an AlbumSet tree.
+'''
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from .utils import info, warn, get_mp_context
+
+
+def _build_album(album, build, pool=None):
+    '''Helper function to build (or only render) a single album'''
+    if build:
+        info (u'Building album [{}]'.format(album.base))
+        album.prepare(pool)
+        album.render()
+    else:
+        info (u'Building album index [{}]'.format(album.base))
+        album.render()
+
+
+class TreeBuilder(object):
+    '''
+    The TreeBuilder class builds all the albums of an AlbumSet tree, along
+    with the indexes of nested album sets.
+
+    With more than one job, independent albums are built concurrently by a
+    pool of threads, which share a single process pool for the CPU-intensive
+    image processing. An album set index is only rendered once all its
+    children are done, so it always reflects the built albums.
+
+    In sharded builds, indexes are not rendered, as they would only list the
+    albums of the shard: see sphog.shard. In merge builds, albums are not
+    built, and indexes are rendered from the album summaries.
+    '''
+    def __init__(self, jobs=1):
+        self.jobs     = jobs
+        self._threads = None
+        self._pool    = None
+        # album -> build future (or build error, when building serially)
+        self._builds = {}
+
+    def build(self, albumset):
+        '''Builds the albums and the nested indexes of `albumset`'''
+        if self.jobs > 1:
+            with ThreadPoolExecutor(max_workers=self.jobs) as threads, \
+                    ProcessPoolExecutor(
+                        max_workers=self.jobs,
+                        mp_context=get_mp_context()
+                        ) as pool:
+                self._threads = threads
+                self._pool = pool
+                self._submit_albums(albumset)
+                self._render_sets(albumset)
+        else:
+            self._submit_albums(albumset)
+            self._render_sets(albumset)
+        self._threads = None
+        self._pool = None
+        self._builds = {}
+
+    def _submit_albums(self, albumset):
+        '''Schedules the build of all the albums of the tree'''
+        build = albumset._build_albums
+        for child in albumset.children:
+            if child.type == 'albumset':
+                self._submit_albums(child)
+            elif albumset._merge:
+                continue
+            elif build or albumset.regen:
+                if self._threads is None:
+                    self._builds[child] = self._run(child, build)
+                else:
+                    # per-album progress bars would overlap
+                    child.progress = False
+                    self._builds[child] = self._threads.submit(
+                        _build_album,
+                        child,
+                        build,
+                        self._pool
+                        )
+
+    def _run(self, album, build):
+        '''Builds an album in the current thread, returns the error if any'''
+        try:
+            _build_album(album, build)
+        except Exception as e:
+            return e
+        return None
+
+    def _wait(self, album):
+        '''Waits for the build of `album`, returns the error if any'''
+        future = self._builds.get(album)
+        if future is None or self._threads is None:
+            return future
+        try:
+            future.result()
+        except Exception as e:
+            return e
+        return None
+
+    def _render_sets(self, albumset):
+        '''
+        Renders the nested album sets, children first, once their albums are
+        built. Albums which failed to build are removed from their parent.
+        '''
+        for child in list(albumset.children):
+            if child.type == 'albumset':
+                self._render_sets(child)
+                if not albumset._recurse or albumset._shard is not None:
+                    continue
+                try:
+                    info (u'Building directory index [{}]'.format(child.url))
+                    child.render()
+                except Exception as e:
+                    warn (u'something went wrong when building album set in {}\n{}'.format(child.path, e))
+                    albumset.children.remove(child)
+            else:
+                e = self._wait(child)
+                if e is not None:
+                    warn(u'something went wrong when building album in {}:\n{}'.format(child.path, e))
+                    albumset.children.remove(child)
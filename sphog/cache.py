@@ -0,0 +1,251 @@
+# encoding: utf-8
+
+'''
+Implementation of the on-disk metadata cache and build state used by albums
+and album sets.
+'''
+
+import os
+import os.path
+import json
+import codecs
+import hashlib
+import threading
+
+from .settings import settings
+from .utils import verbose, warn
+
+# Caches opened so far, indexed by path: see MetadataCache.open()
+_caches = {}
+_lock = threading.Lock()
+
+class MetadataCache(object):
+    '''
+    The MetadataCache class stores per-photo metadata (dimensions, Exif
+    orientation, description and derivative state) in a JSON file located
+    in the album directory. Entries are keyed by filename and are only
+    considered valid while the size and mtime of the original photo are
+    unchanged, so unmodified photos never need to be opened again.
+
+    The cache also holds the build state of generated files: each derivative
+    and output (e.g. index.html) is recorded with a signature of the inputs
+    it was built from, so it is only rebuilt when one of them changes.
+    '''
+    VERSION = 2
+    # Photo metadata fields: entries missing one of them (written by older
+    # versions) are read again, keeping their build state
+    FIELDS = ('width', 'height', 'orientation', 'date')
+
+    def __init__(self, path):
+        self.path     = path
+        self._entries = {}
+        self._outputs = {}
+        self._dirty   = False
+        self._stat    = None
+        self.load()
+
+    @classmethod
+    def open(cls, path):
+        '''
+        Returns the cache stored in `path`. Caches are kept in memory, so a
+        long-running process (e.g. watch mode) only reads a cache file again
+        if it was modified by someone else.
+        '''
+        with _lock:
+            cache = _caches.get(path)
+            if cache is None or cache._stat != _get_stat(path):
+                cache = cls(path)
+                _caches[path] = cache
+        return cache
+
+    def load(self):
+        '''Reads the cache file, silently ignoring missing or stale files'''
+        self._entries = {}
+        self._outputs = {}
+        self._dirty = False
+        self._stat = _get_stat(self.path)
+        if self._stat is None:
+            return
+        try:
+            with codecs.open(self.path, 'rb', 'utf8') as cache_file:
+                data = json.load(cache_file)
+        except (IOError, OSError, ValueError) as e:
+            warn(u'Ignoring unreadable cache file [{}]: {}'.format(self.path, e))
+            return
+        if data.get('version') != self.VERSION:
+            verbose(u'Discarding outdated cache file [{}]'.format(self.path))
+            return
+        self._entries = data.get('photos', {})
+        self._outputs = data.get('outputs', {})
+
+    def save(self):
+        '''
+        Writes the cache file back to disk, if anything changed (and this is
+        not a dry run)
+        '''
+        if not self._dirty or settings.dry_run:
+            return
+        tmp_path = u'{}.tmp'.format(self.path)
+        try:
+            # the cache may be written to an output tree not created yet
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            with codecs.open(tmp_path, 'wb', 'utf8') as cache_file:
+                json.dump(
+                    {
+                        'version': self.VERSION,
+                        'photos': self._entries,
+                        'outputs': self._outputs,
+                        },
+                    cache_file,
+                    sort_keys=True
+                    )
+            os.replace(tmp_path, self.path)
+            self._dirty = False
+            self._stat = _get_stat(self.path)
+        except (IOError, OSError) as e:
+            warn(u'Could not write cache file [{}]: {}'.format(self.path, e))
+
+    def lookup(self, filename, stat):
+        '''
+        Returns the cached entry for `filename`, or None if there is no entry
+        or if the photo changed since it was cached (as reported by `stat`)
+        '''
+        entry = self._entries.get(filename)
+        if entry is None:
+            return None
+        if entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+            return None
+        if any(field not in entry for field in self.FIELDS):
+            return None
+        return entry
+
+    def store(self, filename, stat, meta):
+        '''
+        Stores the metadata of a (new or modified) photo. The derivative
+        state of a modified photo is kept: its signatures include the size
+        and mtime of the original, so the derivatives are seen as outdated.
+        '''
+        entry = dict(meta)
+        entry['size'] = stat.st_size
+        entry['mtime'] = stat.st_mtime
+        entry['derivatives'] = self._entries.get(filename, {}).get(
+            'derivatives',
+            {}
+            )
+        self._entries[filename] = entry
+        self._dirty = True
+        return entry
+
+    def prune(self, filenames):
+        '''Removes the entries of photos which are not part of `filenames`'''
+        for filename in set(self._entries) - set(filenames):
+            del self._entries[filename]
+            self._dirty = True
+
+    def get_desc(self, filename, desc_mtime):
+        '''
+        Returns the cached description of a photo, or None if the
+        description file changed since it was last read (`desc_mtime` is
+        the current mtime of the description file, None if it is missing)
+        '''
+        entry = self._entries.get(filename)
+        if entry is None or 'desc' not in entry:
+            return None
+        if entry.get('desc_mtime') != desc_mtime:
+            return None
+        return entry['desc']
+
+    def set_desc(self, filename, desc_mtime, desc):
+        '''Records the description of a photo with its file mtime'''
+        entry = self._entries.get(filename)
+        if entry is None:
+            return
+        if entry.get('desc') != desc or entry.get('desc_mtime') != desc_mtime:
+            entry['desc'] = desc
+            entry['desc_mtime'] = desc_mtime
+            self._dirty = True
+
+    def get_derivative(self, filename, kind):
+        '''Returns the recorded state of a photo derivative (e.g. thumb)'''
+        entry = self._entries.get(filename)
+        if entry is None:
+            return None
+        return entry['derivatives'].get(kind)
+
+    def get_source(self, filename):
+        '''Returns the (size, mtime) of the original photo, as cached'''
+        entry = self._entries.get(filename)
+        if entry is None:
+            return None
+        return (entry['size'], entry['mtime'])
+
+    def get_hash(self, filename):
+        '''Returns the cached content hash of an original photo, if any'''
+        entry = self._entries.get(filename)
+        if entry is None:
+            return None
+        return entry.get('hash')
+
+    def set_hash(self, filename, digest):
+        '''
+        Records the content hash of an original photo. It is dropped by
+        store() when the photo changes.
+        '''
+        entry = self._entries.get(filename)
+        if entry is None:
+            return
+        if entry.get('hash') != digest:
+            entry['hash'] = digest
+            self._dirty = True
+
+    def set_derivative(self, filename, kind, state):
+        '''Records the state of a freshly generated photo derivative'''
+        entry = self._entries.get(filename)
+        if entry is None:
+            return
+        if entry['derivatives'].get(kind) != state:
+            entry['derivatives'][kind] = state
+            self._dirty = True
+
+    def get_output(self, name):
+        '''Returns the recorded signature of an output file (e.g. index.html)'''
+        return self._outputs.get(name)
+
+    def set_output(self, name, state):
+        '''Records the signature of a freshly generated output file'''
+        if self._outputs.get(name) != state:
+            self._outputs[name] = state
+            self._dirty = True
+
+
+def _get_stat(path):
+    '''Returns the (size, mtime) of `path`, or None if it does not exist'''
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_size, stat.st_mtime)
+
+def signature(*values):
+    '''
+    Returns a signature (a hash) of `values`, which must be serializable to
+    JSON. It is used to record the inputs an output file was built from.
+    '''
+    data = json.dumps(values, sort_keys=True, default=str)
+    return hashlib.sha1(data.encode('utf8')).hexdigest()
+
+def file_signature(path):
+    '''Returns a signature of the content of `path`, or None if missing'''
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except (IOError, OSError):
+        return None
+
+def config_signature(config):
+    '''Returns a signature of all the values of a ConfigParser object'''
+    return signature(dict(
+        (section, dict(config.items(section, raw=True)))
+        for section in config.sections()
+        ))
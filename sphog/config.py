@@ -0,0 +1,45 @@
+# encoding: utf-8
+
+'''
+Helper functions to read configuration files (site.config, album.def and
+index.def).
+'''
+
+import os
+import configparser
+import threading
+
+# Parsed configurations, indexed by the list of files they were read from,
+# and validated with the (size, mtime) of these files. Long-running
+# processes (e.g. watch mode) don't need to parse unchanged files again.
+_configs = {}
+_lock = threading.Lock()
+
+
+def _get_stats(filenames):
+    stats = []
+    for filename in filenames:
+        try:
+            stat = os.stat(filename)
+            stats.append((stat.st_size, stat.st_mtime))
+        except OSError:
+            stats.append(None)
+    return tuple(stats)
+
+def read_config(filenames):
+    '''
+    Returns a ConfigParser object holding the configuration read from
+    `filenames` (later files override earlier ones). The returned object is
+    shared, and must not be modified.
+    '''
+    key = tuple(filenames)
+    stats = _get_stats(filenames)
+    with _lock:
+        cached = _configs.get(key)
+    if cached is not None and cached[0] == stats:
+        return cached[1]
+    config = configparser.ConfigParser()
+    config.read(filenames, encoding='utf8')
+    with _lock:
+        _configs[key] = (stats, config)
+    return config
@@ -0,0 +1,151 @@
+# encoding: utf-8
+
+'''
+Header-only JPEG metadata reader: parses the SOF and APP1 (Exif) segments of
+a JPEG file to find its dimensions, Exif orientation and capture date,
+without decoding anything else. Files it does not understand are left to
+Pillow (see imaging.read_metadata).
+'''
+
+import struct
+
+# Start Of Frame markers (baseline, progressive, lossless...): all but DHT
+# (0xC4), JPG (0xC8) and DAC (0xCC)
+SOF_MARKERS = frozenset(
+    range(0xC0, 0xD0)
+    ) - frozenset((0xC4, 0xC8, 0xCC))
+# Markers without a segment length
+STANDALONE_MARKERS = frozenset(range(0xD0, 0xDA)) | frozenset((0x01,))
+APP1 = 0xE1
+SOS = 0xDA
+
+# Exif tags
+TAG_ORIENTATION = 0x0112
+TAG_DATETIME = 0x0132
+TAG_EXIF_IFD = 0x8769
+TAG_DATETIME_ORIGINAL = 0x9003
+
+# Exif field types: SHORT, LONG and ASCII
+TYPE_ASCII = 2
+TYPE_SHORT = 3
+TYPE_LONG = 4
+
+
+class _Unsupported(Exception):
+    '''Raised when a file can not be handled by the header-only reader'''
+
+
+def _read_ifd(data, endian, offset):
+    '''Returns the entries of the Exif IFD at `offset`, keyed by tag'''
+    if offset + 2 > len(data):
+        raise _Unsupported()
+    count = struct.unpack_from(endian + 'H', data, offset)[0]
+    if offset + 2 + count * 12 > len(data):
+        raise _Unsupported()
+    entries = {}
+    for i in range(count):
+        entry = offset + 2 + i * 12
+        tag, kind, length = struct.unpack_from(endian + 'HHI', data, entry)
+        entries[tag] = (kind, length, entry + 8)
+    return entries
+
+def _get_int(data, endian, entry):
+    '''Returns the value of a SHORT or LONG Exif entry'''
+    kind, _, offset = entry
+    if kind == TYPE_SHORT:
+        return struct.unpack_from(endian + 'H', data, offset)[0]
+    if kind == TYPE_LONG:
+        return struct.unpack_from(endian + 'I', data, offset)[0]
+    raise _Unsupported()
+
+def _get_string(data, endian, entry):
+    '''Returns the value of an ASCII Exif entry'''
+    kind, length, offset = entry
+    if kind != TYPE_ASCII:
+        return None
+    if length > 4:
+        offset = struct.unpack_from(endian + 'I', data, offset)[0]
+    value = data[offset:offset + length].split(b'\0', 1)[0]
+    return value.decode('ascii', 'replace').strip() or None
+
+def _parse_exif(data):
+    '''
+    Parses the TIFF structure of an Exif segment (without its header).
+    Returns an (orientation, date) tuple.
+    '''
+    if data[:4] == b'II*\0':
+        endian = '<'
+    elif data[:4] == b'MM\0*':
+        endian = '>'
+    else:
+        raise _Unsupported()
+    ifd0 = _read_ifd(data, endian, struct.unpack_from(endian + 'I', data, 4)[0])
+    orientation = 1
+    if TAG_ORIENTATION in ifd0:
+        orientation = _get_int(data, endian, ifd0[TAG_ORIENTATION])
+    date = None
+    if TAG_EXIF_IFD in ifd0:
+        exif = _read_ifd(data, endian, _get_int(data, endian, ifd0[TAG_EXIF_IFD]))
+        if TAG_DATETIME_ORIGINAL in exif:
+            date = _get_string(data, endian, exif[TAG_DATETIME_ORIGINAL])
+    if date is None and TAG_DATETIME in ifd0:
+        date = _get_string(data, endian, ifd0[TAG_DATETIME])
+    return orientation, date
+
+def _read_header(f):
+    '''Parses the JPEG segments of the open file `f`, up to the frame header'''
+    if f.read(2) != b'\xff\xd8':
+        raise _Unsupported()
+    orientation = 1
+    date = None
+    while True:
+        byte = f.read(1)
+        if byte != b'\xff':
+            raise _Unsupported()
+        marker = f.read(1)
+        # skip fill bytes
+        while marker == b'\xff':
+            marker = f.read(1)
+        if not marker:
+            raise _Unsupported()
+        marker = ord(marker)
+        if marker in STANDALONE_MARKERS:
+            continue
+        if marker == SOS:
+            # no frame header before the image data
+            raise _Unsupported()
+        length = f.read(2)
+        if len(length) != 2:
+            raise _Unsupported()
+        length = struct.unpack('>H', length)[0] - 2
+        if marker in SOF_MARKERS:
+            frame = f.read(5)
+            if len(frame) != 5:
+                raise _Unsupported()
+            height, width = struct.unpack('>HH', frame[1:5])
+            if width == 0 or height == 0:
+                raise _Unsupported()
+            return {
+                'width': width,
+                'height': height,
+                'orientation': orientation,
+                'date': date,
+                }
+        if marker == APP1:
+            data = f.read(length)
+            if data[:6] == b'Exif\0\0':
+                orientation, date = _parse_exif(data[6:])
+        else:
+            f.seek(length, 1)
+
+def read_jpeg_header(path):
+    '''
+    Returns the dimensions, Exif orientation and capture date of a JPEG
+    file, as a dict, reading only its headers. Returns None if the file is
+    not a JPEG file or holds unusual or malformed data.
+    '''
+    try:
+        with open(path, 'rb') as f:
+            return _read_header(f)
+    except (_Unsupported, struct.error):
+        return None
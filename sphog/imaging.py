@@ -0,0 +1,433 @@
+# encoding: utf-8
+
+'''
+Image processing helpers used to read photo metadata and to generate
+photo derivatives (thumbnails, previews and album thumbnails).
+'''
+
+import io
+import importlib
+import os
+import math
+
+from .exif import read_jpeg_header
+from .output import write_file
+from .profiler import profiler
+from .utils import verbose, error, warn, LazyModule
+
+# Pillow is only imported when an image is actually decoded or encoded
+Image = LazyModule('PIL.Image')
+features = LazyModule('PIL.features')
+
+# Python2 does not know about FileNotFoundError, map it if needed
+try:
+    FileNotFoundError
+except NameError:
+    FileNotFoundError = IOError
+
+# Exif orientation tag, and the rotation (in degrees) each value stands for
+EXIF_ORIENTATION = 0x0112
+# Exif capture date tags, see read_metadata()
+EXIF_DATETIME = 0x0132
+EXIF_IFD = 0x8769
+EXIF_DATETIME_ORIGINAL = 0x9003
+ORIENTATION_ROTATION = {3: 180, 6: 270, 8: 90}
+# Names of the matching Pillow transpose methods
+ORIENTATION_TRANSPOSE = {
+    3: 'ROTATE_180',
+    6: 'ROTATE_270',
+    8: 'ROTATE_90',
+    }
+
+# JPEG draft mode decodes a downscaled image (1/2, 1/4 or 1/8). Ask for an
+# image at least DRAFT_MARGIN times larger than the largest target, so that
+# the final resampling step still has some room to work properly.
+DRAFT_MARGIN = 2
+# JPEG draft scales, from the smallest decoded image to the largest
+DRAFT_SCALES = (8, 4, 2, 1)
+# In bounded-memory mode, resizes first reduce the image with a box filter,
+# as long as it stays REDUCING_GAP times larger than the target
+REDUCING_GAP = 2.0
+# Estimated bytes per pixel of a decoded image, and number of full-size
+# images alive at once (the decoded image and its first transform)
+BYTES_PER_PIXEL = 3
+PEAK_COPIES = 2
+
+# Output formats of the responsive images ladder, and their file extension
+SRCSET_FORMATS = {
+    'jpeg': 'jpg',
+    'webp': 'webp',
+    'avif': 'avif',
+    }
+# Modes which can be saved in all formats: others are converted to RGB
+PORTABLE_MODES = ('RGB', 'RGBA', 'L')
+# Formats supported by the installed Pillow, see get_formats()
+_supported_formats = {}
+
+
+def get_formats(names):
+    '''
+    Returns the formats of `names` (e.g. ['webp', 'avif']) which the installed
+    Pillow is able to write. Unsupported formats are reported once.
+    '''
+    formats = []
+    for name in names:
+        if name not in _supported_formats:
+            if name == 'jpeg':
+                supported = True
+            elif name == 'webp':
+                supported = features.check('webp')
+            elif name == 'avif':
+                # native since Pillow 11.3, or through pillow-avif-plugin,
+                # which registers the format when imported
+                try:
+                    importlib.import_module('pillow_avif')
+                except ImportError:
+                    pass
+                Image.init()
+                supported = 'AVIF' in Image.SAVE
+            else:
+                supported = False
+            if not supported:
+                warn(u'Image format {} is not supported, skipping it'.format(name))
+            _supported_formats[name] = supported
+        if _supported_formats[name]:
+            formats.append(name)
+    return formats
+
+def get_encoder(config, name, default=None):
+    '''
+    Returns the options of the encoder profile `name`, defined in a
+    [profile:<name>] config section, as a dict. Available options are:
+    - quality: the encoder quality (JPEG, WebP and AVIF)
+    - progressive, optimize: booleans enabling these JPEG features
+    - subsampling: the JPEG chroma subsampling (e.g. 4:4:4, 4:2:0)
+    - strip_metadata: whether to drop the Exif metadata (default: yes)
+    - icc: whether to keep or strip the ICC color profile (default: strip)
+    `default` is returned when `name` is empty.
+    '''
+    if name == '':
+        return dict(default or {})
+    section = 'profile:{}'.format(name)
+    if not config.has_section(section):
+        raise ValueError(u'Unknown encoder profile [{}]'.format(name))
+    encoder = {}
+    if config.has_option(section, 'quality'):
+        encoder['quality'] = config.getint(section, 'quality')
+    for key in ('progressive', 'optimize', 'strip_metadata'):
+        if config.has_option(section, key):
+            encoder[key] = config.getboolean(section, key)
+    if config.has_option(section, 'subsampling'):
+        encoder['subsampling'] = config.get(section, 'subsampling')
+    if config.has_option(section, 'icc'):
+        encoder['icc'] = config.get(section, 'icc')
+        if encoder['icc'] not in ('keep', 'strip'):
+            raise ValueError(
+                u'Invalid icc value [{}] in encoder profile [{}]'.format(
+                    encoder['icc'],
+                    name
+                    ))
+    return encoder
+
+def allow_huge_images():
+    '''
+    Disables the Pillow decompression bomb check: in bounded-memory mode,
+    the decoded size of huge images is limited by max_pixels instead
+    '''
+    Image.MAX_IMAGE_PIXELS = None
+
+def _read_pillow_metadata(path):
+    '''
+    Helper function to read the metadata of a photo with Pillow, for files
+    the header-only reader does not handle
+    '''
+    with Image.open(path) as img:
+        exif = img.getexif()
+        date = exif.get_ifd(EXIF_IFD).get(EXIF_DATETIME_ORIGINAL)
+        if date is None:
+            date = exif.get(EXIF_DATETIME)
+        if isinstance(date, str):
+            date = date.strip('\0 ') or None
+        else:
+            date = None
+        return {
+            'width': img.size[0],
+            'height': img.size[1],
+            'orientation': exif.get(EXIF_ORIENTATION, 1),
+            'date': date,
+            }
+
+def read_metadata(path):
+    '''
+    Helper function to read the raw size, Exif orientation and capture date
+    of a photo. Only the image headers are parsed, pixel data is not decoded:
+    JPEG files are handled by a header-only reader, which leaves anything
+    unusual to Pillow.
+    '''
+    with profiler.stage('exif'):
+        meta = None
+        if path.lower().endswith(('.jpg', '.jpeg')):
+            meta = read_jpeg_header(path)
+        if meta is None:
+            meta = _read_pillow_metadata(path)
+        return meta
+
+def _crop_center(pil_img, crop_width, crop_height):
+    '''Helper function to crop a square image from a rectangle image'''
+    img_width, img_height = pil_img.size
+    return pil_img.crop(((img_width - crop_width) // 2,
+                         (img_height - crop_height) // 2,
+                         (img_width + crop_width) // 2,
+                         (img_height + crop_height) // 2))
+
+def _crop_square(pil_img, width):
+    '''Helper function to crop and resize the center square of an image'''
+    side = min(pil_img.size)
+    return _crop_center(pil_img, side, side).resize(
+        (width, width),
+        Image.LANCZOS
+        )
+
+def _get_min_size(targets, square=None):
+    '''Returns the smallest size an original can be decoded to for `targets`'''
+    min_size = (0, 0)
+    for _, size, _ in targets:
+        min_size = (max(min_size[0], size[0]), max(min_size[1], size[1]))
+    if square is not None:
+        min_size = (max(min_size[0], square[1]), max(min_size[1], square[1]))
+    return min_size
+
+def _get_draft_size(min_size, max_pixels=None):
+    '''
+    Returns the size requested to the JPEG decoder: DRAFT_MARGIN times
+    `min_size`, unless this exceeds `max_pixels`
+    '''
+    margin = DRAFT_MARGIN
+    if max_pixels is not None and min_size[0] * min_size[1] > 0:
+        margin = min(margin, max(
+            1.0,
+            math.sqrt(max_pixels / (min_size[0] * min_size[1]))
+            ))
+    return (int(min_size[0] * margin), int(min_size[1] * margin))
+
+def estimate_decoded_size(path, size, min_size, max_pixels=None):
+    '''
+    Returns the size an original of `size` pixels, located in `path`, is
+    decoded to when generating derivatives of at least `min_size`: JPEG
+    originals are decoded at a reduced scale, like the decoder would.
+    '''
+    width, height = size
+    if path.lower().endswith(('.jpg', '.jpeg')):
+        request = _get_draft_size(min_size, max_pixels)
+        scale = min(
+            width // max(request[0], 1),
+            height // max(request[1], 1)
+            )
+        for s in DRAFT_SCALES:
+            if s <= scale:
+                width = (width + s - 1) // s
+                height = (height + s - 1) // s
+                break
+    return width, height
+
+def estimate_memory(path, size, min_size, max_pixels=None):
+    '''
+    Returns an estimation of the peak memory (in bytes) needed to generate
+    derivatives of at least `min_size` from the original in `path`, of
+    `size` pixels
+    '''
+    width, height = estimate_decoded_size(path, size, min_size, max_pixels)
+    return width * height * BYTES_PER_PIXEL * PEAK_COPIES
+
+def _reduce(img, min_size, max_pixels):
+    '''
+    Helper function reducing a decoded image by an integer factor (box
+    filter), until it holds at most `max_pixels`, but not below `min_size`
+    '''
+    width, height = img.size
+    if width * height <= max_pixels:
+        return img
+    factor = min(
+        int(math.ceil(math.sqrt(width * height / max_pixels))),
+        width // max(min_size[0], 1),
+        height // max(min_size[1], 1)
+        )
+    if factor < 2:
+        return img
+    verbose(u'{} is reduced by {}'.format(img.filename, factor))
+    return img.reduce(factor)
+
+def _decode(img, orientation, min_size, max_pixels=None):
+    '''
+    Helper function to decode an opened image, applying the Exif orientation.
+    `min_size` is the smallest acceptable size (in displayed orientation):
+    JPEG images are decoded at a reduced scale (DCT scaling) when possible.
+    When `max_pixels` is set, the decoded image is reduced to this number of
+    pixels (if the targets allow it) before being transposed, so that no
+    full-size copy is made.
+    '''
+    filename = img.filename
+    if orientation in (6, 8):
+        min_size = (min_size[1], min_size[0])
+    img.draft(img.mode, _get_draft_size(min_size, max_pixels))
+    if max_pixels is not None:
+        img.load()
+        img = _reduce(img, min_size, max_pixels)
+    if orientation in ORIENTATION_TRANSPOSE:
+        verbose('{} needs rotation: {}°'.format(
+            filename,
+            ORIENTATION_ROTATION[orientation]
+            ))
+        return img.transpose(getattr(Image, ORIENTATION_TRANSPOSE[orientation]))
+    img.load()
+    return img
+
+def _gen_derivatives(path_in, orientation, targets, square=None,
+                     max_pixels=None, data=None, write=None):
+    '''
+    Helper function to generate several smaller versions of a photo
+    (e.g. thumbnails, preview) from a single decode of the original.
+
+    `targets` is a list of (path, (width, height), encoder) tuples, and
+    `square` an optional (path, width, encoder) tuple describing a square
+    album thumbnail, where `encoder` holds encoder profile options (see
+    get_encoder). The original is decoded once, then each target is derived
+    from the previous (larger) one. The format of each target is given by
+    its extension (e.g. .jpg, .webp or .avif).
+
+    In bounded-memory mode (`max_pixels` set), the original is decoded to at
+    most `max_pixels` when possible, and resizes are staged: the image is
+    first reduced with a box filter, then resampled.
+
+    When the original has been prefetched, `data` holds its content, and it
+    is not read again. `write` is an optional function writing the encoded
+    derivatives, see _save().
+    '''
+    min_size = _get_min_size(targets, square)
+    sizes = {}
+    for path_out, size, encoder in targets:
+        sizes.setdefault(tuple(size), []).append((path_out, encoder))
+    params = {}
+    if max_pixels is not None:
+        allow_huge_images()
+        params['reducing_gap'] = REDUCING_GAP
+    if data is None:
+        size_in = os.path.getsize(path_in)
+        original = path_in
+    else:
+        size_in = len(data)
+        original = io.BytesIO(data)
+    with Image.open(original) as img:
+        if data is not None:
+            # name the image after the original, for messages
+            img.filename = path_in
+        with profiler.stage('decode') as stage:
+            source = _decode(img, orientation, min_size, max_pixels)
+            stage.add(bytes_read=size_in, images=1)
+        if source is not img:
+            # release the full-size decoded image as soon as possible
+            img.close()
+        if square is not None:
+            with profiler.stage('resize'):
+                thumbnail = _crop_square(source, square[1])
+            _save(thumbnail, square[0], square[2], write)
+        # targets share the same aspect ratio: going from the largest to
+        # the smallest, each one can be derived from the previous one.
+        # Targets of the same size (e.g. other formats) share the resize.
+        for size in sorted(sizes, reverse=True):
+            with profiler.stage('resize'):
+                source = source.resize(size, Image.LANCZOS, **params)
+            for path_out, encoder in sizes[size]:
+                _save(source, path_out, encoder, write)
+
+def _get_save_params(img, path_out, encoder):
+    '''Helper function to convert encoder options to Pillow save() params'''
+    params = {}
+    if 'quality' in encoder:
+        params['quality'] = encoder['quality']
+    if path_out.lower().endswith(('.jpg', '.jpeg')):
+        for key in ('progressive', 'optimize', 'subsampling'):
+            if key in encoder:
+                params[key] = encoder[key]
+    if encoder.get('icc', 'strip') == 'keep' and 'icc_profile' in img.info:
+        params['icc_profile'] = img.info['icc_profile']
+    if not encoder.get('strip_metadata', True) and 'exif' in img.info:
+        # the orientation has already been applied to the pixels
+        exif = img.getexif()
+        exif[EXIF_ORIENTATION] = 1
+        params['exif'] = exif.tobytes()
+    return params
+
+def _save(img, path_out, encoder=None, write=None):
+    '''
+    Helper function to encode and write a derivative. The output format is
+    given by the file extension, and encoder options by `encoder`. The image
+    is encoded in memory first, and not written if the file already holds
+    the same data. When provided, `write(path_out, data)` writes the
+    encoded data instead (e.g. in the background).
+    '''
+    with profiler.stage('encode') as stage:
+        params = _get_save_params(img, path_out, encoder or {})
+        if (not path_out.lower().endswith(('.jpg', '.jpeg'))
+                and img.mode not in PORTABLE_MODES):
+            img = img.convert('RGB')
+        data = io.BytesIO()
+        img.save(
+            data,
+            Image.registered_extensions()[os.path.splitext(path_out)[1].lower()],
+            **params
+            )
+        if write is not None:
+            write(path_out, data.getvalue())
+            stage.add(bytes_written=len(data.getvalue()))
+        else:
+            stage.add(bytes_written=write_file(path_out, data.getvalue()))
+
+def _gen_derivatives_task(task, profile=False, write=None):
+    '''
+    Wrapper around _gen_derivatives, suitable for worker processes: `task` is
+    a tuple of _gen_derivatives arguments. Returns an (error, stats) tuple:
+    errors are not raised but returned as a string (None on success), so
+    that a failing photo can be reported without aborting the whole album.
+    When `profile` is set (in worker processes), the stages are profiled
+    and returned as stats (None otherwise). `write` is passed to
+    _gen_derivatives.
+    '''
+    if profile:
+        profiler.enabled = True
+    try:
+        _gen_derivatives(*task, write=write)
+        err = None
+    except Exception as e:
+        err = u'{}'.format(e)
+    if profile:
+        return err, profiler.pop()
+    return err, None
+
+def _gen_thumbnail(file_in, file_out, width=450, encoder=None, max_pixels=None):
+    '''
+    Helper function to generate a square thumbnail from a large picture
+    '''
+    if encoder is None:
+        encoder = {'quality': 95}
+    try:
+        orientation = read_metadata(file_in)['orientation']
+        _gen_derivatives(
+            file_in,
+            orientation,
+            [],
+            square=(file_out, width, encoder),
+            max_pixels=max_pixels
+            )
+        return True
+    except (FileNotFoundError, IsADirectoryError):
+        error('Could not find thumbnail source [{}]'.format(file_in))
+        return False
+
+def _gen_image_copy(path_in, path_out, size, encoder=None):
+    '''
+    Helper function to generate a smaller version of a photo
+    (e.g. thumbnails, preview)
+    '''
+    orientation = read_metadata(path_in)['orientation']
+    _gen_derivatives(path_in, orientation, [(path_out, size, encoder or {})])
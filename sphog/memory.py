@@ -0,0 +1,74 @@
+# encoding: utf-8
+
+'''
+Implementation of the memory budget used by the bounded-memory mode: photos
+are only handed to worker processes while the estimated memory of the
+images being processed fits in the budget, so that several huge images
+(e.g. panoramas) never get decoded at the same time.
+'''
+
+import threading
+
+# Budget shared by all the albums built by the process, see get_budget()
+_budget = None
+_lock = threading.Lock()
+
+
+def get_budget(config):
+    '''
+    Returns the MemoryBudget configured by the [global] memory_budget option
+    (in MiB), or None if memory is not bounded. The budget is shared by all
+    the albums built concurrently.
+    '''
+    global _budget
+    capacity = config.getint('global', 'memory_budget', fallback=0)
+    if capacity <= 0:
+        return None
+    capacity *= 1024 * 1024
+    with _lock:
+        if _budget is None or _budget.capacity != capacity:
+            _budget = MemoryBudget(capacity)
+        return _budget
+
+def get_max_pixels(config):
+    '''
+    Returns the [global] max_pixels option: the largest number of pixels an
+    original is decoded to (None if unbounded)
+    '''
+    max_pixels = config.getint('global', 'max_pixels', fallback=0)
+    if max_pixels <= 0:
+        return None
+    return max_pixels
+
+
+class MemoryBudget(object):
+    '''
+    The MemoryBudget class accounts the memory reserved by running tasks. A
+    task larger than the whole budget can still run, but only alone.
+    '''
+    def __init__(self, capacity):
+        self.capacity   = capacity
+        self._used      = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, amount, blocking=True):
+        '''
+        Reserves `amount` bytes, waiting for running tasks to release them if
+        needed. Returns False if `blocking` is not set and the memory is not
+        available.
+        '''
+        amount = min(amount, self.capacity)
+        with self._condition:
+            while self._used + amount > self.capacity:
+                if not blocking:
+                    return False
+                self._condition.wait()
+            self._used += amount
+        return True
+
+    def release(self, amount):
+        '''Releases `amount` bytes reserved by acquire()'''
+        amount = min(amount, self.capacity)
+        with self._condition:
+            self._used -= amount
+            self._condition.notify_all()
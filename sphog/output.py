@@ -0,0 +1,200 @@
+# encoding: utf-8
+
+'''
+Helper functions to write generated files. Text files (HTML pages, JSON
+chunks) can be written along with their precompressed variants: .gz files,
+and .br files when a brotli module is available. Web servers can serve these
+variants directly, instead of compressing the files on every request.
+
+Files are only written when their content changed, so that unchanged files
+keep their mtime, and syncing the site only transfers actual changes. With
+the [global] output_root option, generated files are written to a separate
+tree, which mirrors the site root.
+'''
+
+import os
+import os.path
+import gzip
+import shutil
+import threading
+
+from .profiler import profiler
+from .utils import scan_dir, verbose
+
+# brotli is optional: .br variants are only written when it is installed
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Extensions of the precompressed variants
+SIDECARS = ('.gz', '.br')
+
+
+def get_precompress(config):
+    '''Returns whether the [global] precompress option is enabled'''
+    return config.getboolean('global', 'precompress', fallback=False)
+
+def get_output_root(config):
+    '''
+    Returns the [global] output_root directory, or None if generated files
+    are written next to their sources
+    '''
+    root = config.get('global', 'output_root', fallback='')
+    if root == '':
+        return None
+    return os.path.abspath(root)
+
+def get_output_path(config, path):
+    '''
+    Returns the path where files generated for `path` (a path of the site
+    tree, e.g. an album directory) are written
+    '''
+    root = get_output_root(config)
+    if root is None:
+        return path
+    relpath = os.path.relpath(path, config.get('global', 'siteroot'))
+    if relpath == os.pardir or relpath.startswith(os.pardir + os.sep):
+        raise ValueError(u'[{}] is not in the site root'.format(path))
+    return os.path.normpath(os.path.join(root, relpath))
+
+def _compress_gzip(data):
+    # a fixed mtime keeps the output identical for identical content
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+def _compress_brotli(data):
+    return brotli.compress(data, quality=11)
+
+def _get_compressors():
+    '''Returns the available (extension, compress function) pairs'''
+    compressors = [('.gz', _compress_gzip)]
+    if brotli is not None:
+        compressors.append(('.br', _compress_brotli))
+    return compressors
+
+def _is_unchanged(path, data):
+    '''Checks whether `path` already holds `data`'''
+    try:
+        if os.path.getsize(path) != len(data):
+            return False
+        with open(path, 'rb') as f:
+            return f.read() == data
+    except (IOError, OSError):
+        return False
+
+def _write(path, data):
+    # write to a temporary file first: `path` may be a hardlink to a source
+    # file (see publish_file), which must never be modified
+    tmp = u'{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+    try:
+        with open(tmp, 'wb') as out:
+            out.write(data)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def is_source_only(name):
+    '''
+    Checks whether the site file `name` is only read by sphog, and never
+    published: definition files, descriptions, and hidden files (e.g.
+    metadata caches)
+    '''
+    return name.startswith('.') or name.endswith(('.def', '.desc', '.config', '.tmp'))
+
+def write_file(path, data):
+    '''
+    Writes the bytes `data` to `path`, unless it already holds them. Returns
+    the number of bytes written.
+    '''
+    if _is_unchanged(path, data):
+        return 0
+    _write(path, data)
+    return len(data)
+
+def publish_file(src, dst):
+    '''
+    Publishes the original file `src` at `dst` in the output tree: `dst` is a
+    hardlink to `src`, or a copy when linking is not possible (e.g. across
+    devices). Nothing is written when `dst` is already up to date. Returns
+    True if `dst` was written.
+    '''
+    try:
+        stat = os.stat(dst)
+        src_stat = os.stat(src)
+        if ((stat.st_dev, stat.st_ino) == (src_stat.st_dev, src_stat.st_ino)
+                or (stat.st_size, stat.st_mtime) == (src_stat.st_size, src_stat.st_mtime)):
+            return False
+    except OSError:
+        pass
+    tmp = dst + '.tmp'
+    if os.path.lexists(tmp):
+        # never copy over a leftover link to the original
+        os.remove(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        # copies keep the mtime of the original, so they are not copied again
+        shutil.copy2(src, tmp)
+        os.chmod(tmp, 0o644)
+    os.replace(tmp, dst)
+    return True
+
+def publish_dir(src, dst, recurse=False, exclude=()):
+    '''
+    Publishes the files of the site directory `src` (except source-only
+    files) to `dst` in the output tree, with their subdirectories when
+    `recurse` is set (except those named in `exclude`)
+    '''
+    dirs, files = scan_dir(src)
+    for entry in files:
+        if is_source_only(entry.name):
+            continue
+        if not os.path.isdir(dst):
+            os.makedirs(dst)
+        if publish_file(entry.path, os.path.join(dst, entry.name)):
+            verbose(u'Published {}'.format(entry.path))
+    if recurse:
+        for entry in dirs:
+            if entry.name not in exclude and not entry.name.startswith('.'):
+                publish_dir(entry.path, os.path.join(dst, entry.name), True)
+
+def remove_output(path):
+    '''Removes a generated file and its precompressed variants'''
+    for p in [path] + [path + ext for ext in SIDECARS]:
+        try:
+            os.remove(p)
+        except OSError:
+            pass
+
+def write_output(path, content, precompress=False):
+    '''
+    Writes the text `content` to `path` (UTF-8), and its precompressed
+    variants at maximum compression when `precompress` is set. Nothing is
+    written if `path` and its variants already hold this content. Variants
+    which are not written (e.g. `precompress` is not set) are removed, so
+    that they never get stale. Returns the number of bytes written.
+    '''
+    data = content.encode('utf8')
+    compressors = _get_compressors() if precompress else []
+    for ext in SIDECARS:
+        if ext not in dict(compressors):
+            try:
+                os.remove(path + ext)
+            except OSError:
+                pass
+    if _is_unchanged(path, data) and all(
+            os.path.isfile(path + ext) for ext, _ in compressors):
+        return 0
+    _write(path, data)
+    size = len(data)
+    if not compressors:
+        return size
+    with profiler.stage('compress') as stage:
+        for ext, compress in compressors:
+            compressed = compress(data)
+            _write(path + ext, compressed)
+            size += len(compressed)
+            stage.add(bytes_read=len(data), bytes_written=len(compressed))
+    return size
@@ -1,79 +1,334 @@
 import os.path
 import codecs
+import threading
+import weakref
 
-from PIL import Image, ExifTags
+from .imaging import read_metadata, get_formats, ORIENTATION_ROTATION, SRCSET_FORMATS
+from .output import get_output_path
 from .utils import verbose
 
+# Number of characters of the derivative versions appended to URLs
+VERSION_LENGTH = 10
+
+# Photo settings, shared by the photos of an album, indexed by the id of
+# their (shared, read-only) config object, see get_photo_settings(). Entries
+# go away with the last photo using them (e.g. between watch mode rebuilds),
+# and each one holds its config, so ids are not reused while it exists.
+_settings = weakref.WeakValueDictionary()
+_lock = threading.Lock()
+
+def _parse_list(list_str):
+    '''Helper function to parse a comma-separated config value'''
+    return [item.strip() for item in list_str.split(',') if item.strip() != '']
+
+def get_generated_prefixes(config):
+    '''Returns the filename prefixes of the photo derivatives'''
+    return [
+        config.get('photos', 'thumb_prefix'),
+        config.get('photos', 'preview_prefix'),
+        config.get('photos', 'srcset_prefix', fallback='srcset_'),
+        ]
+
+def get_srcset_formats(config):
+    '''Returns the formats of the responsive images ladder'''
+    return get_formats(_parse_list(
+        config.get('photos', 'srcset_formats', fallback='jpeg')
+        ))
+
+class PhotoSettings(object):
+    '''
+    The PhotoSettings class holds the [photos] options of an album, parsed
+    once and shared by all its photos, so that Photo objects only store
+    their own data.
+    '''
+    def __init__(self, config):
+        self.config         = config
+        self.thumb_prefix   = config.get('photos', 'thumb_prefix')
+        self.preview_prefix = config.get('photos', 'preview_prefix')
+        self.thumb_height   = config.getint('photos', 'thumb_height')
+        self.preview_height = config.getint('photos', 'preview_height')
+        self.srcset_prefix  = config.get('photos', 'srcset_prefix', fallback='srcset_')
+        self.srcset_widths  = sorted(int(w) for w in _parse_list(
+            config.get('photos', 'srcset_widths', fallback='')
+            ))
+        self.srcset_formats = get_srcset_formats(config)
+        self.photodir       = config.get('album', 'photodir')
+        self._output_dirs   = {}
+
+    def get_output_dir(self, dirname):
+        '''Returns the directory derivatives of photos in `dirname` go to'''
+        outdir = self._output_dirs.get(dirname)
+        if outdir is None:
+            outdir = get_output_path(self.config, dirname)
+            self._output_dirs[dirname] = outdir
+        return outdir
+
+def get_photo_settings(config):
+    '''Returns the PhotoSettings of `config`, parsed once per config'''
+    with _lock:
+        settings = _settings.get(id(config))
+        if settings is None:
+            settings = PhotoSettings(config)
+            _settings[id(config)] = settings
+    return settings
+
 class Photo(object):
-    def __init__(self, path, config, pprev=None, pnext=None, title=None):
+    '''
+    The Photo class holds the metadata of an original photo. Photo objects
+    are kept compact, as albums may hold tens of thousands of them: derived
+    paths and sizes are computed when needed, options are shared through a
+    PhotoSettings object, and neighbours are looked up by index in the
+    ordered photo list of the album.
+    '''
+    __slots__ = (
+        'path', '_settings', '_width', '_height', 'orientation', 'date',
+        'desc', '_title', 'page', 'versions', 'index', '_photos',
+        )
+
+    def __init__(self, path, config, title=None, meta=None):
         self.path         = path
-        self.config       = config
-        self.filename     = os.path.basename(self.path)
-        self.dirname      = os.path.dirname(self.path)
-        self.prev         = pprev
-        self.next         = pnext
-        self.thumb_path   = os.path.join(self.dirname, \
-                    '%s%s'%(config.get('photos', 'thumb_prefix'), self.filename))
-        self.preview_path = os.path.join(self.dirname, \
-                    '%s%s'%(config.get('photos', 'preview_prefix'), self.filename))
-        self.size         = Image.open(self.path).size
-        self.width, self.height = self.get_dimensions()
-        self.is_square    = self.width == self.height
-        self.is_vertical  = self.width < self.height
+        self._settings    = get_photo_settings(config)
+        if meta is None:
+            meta = read_metadata(self.path)
+        self.orientation  = meta['orientation']
+        self.date         = meta.get('date')
+        self._width, self._height = meta['width'], meta['height']
+        rotation = ORIENTATION_ROTATION.get(self.orientation, 0)
+        if rotation in (90, 270):
+            # swap height and width when rotation is 90 or 270
+            self._width, self._height = self._height, self._width
+        if rotation > 0:
+            # Exif orientation is set, we need to reflect it in our data
+            verbose ('{} needs orientation fix: {}°'.format(self.path, rotation))
         self.desc         = None
-        self.title        = title or self.filename
+        self._title       = title
         self.page         = None
-        self.photodir     = config.get('album', 'photodir')
-        self.href         = os.path.join(self.photodir, self.filename)
-        self.preview      = os.path.join(self.photodir, os.path.basename(self.preview_path))
-        self.thumb        = os.path.join(self.photodir, os.path.basename(self.thumb_path))
-        self.preview_width, self.preview_height = self.get_preview_size()
-        self.thumb_width, self.thumb_height = self.get_thumb_size()
+        self.versions     = None
+        self.index        = None
+        self._photos      = None
+
+    @property
+    def config(self):
+        return self._settings.config
+
+    @config.setter
+    def config(self, config):
+        self._settings = get_photo_settings(config)
+
+    @property
+    def filename(self):
+        return os.path.basename(self.path)
+
+    @property
+    def dirname(self):
+        return os.path.dirname(self.path)
+
+    @property
+    def title(self):
+        return self._title or self.filename
+
+    @title.setter
+    def title(self, title):
+        self._title = title
+
+    @property
+    def size(self):
+        '''The size of the original image, before Exif orientation'''
+        if ORIENTATION_ROTATION.get(self.orientation, 0) in (90, 270):
+            return (self._height, self._width)
+        return (self._width, self._height)
+
+    @property
+    def width(self):
+        return self._width
+
+    @property
+    def height(self):
+        return self._height
+
+    @property
+    def is_square(self):
+        return self._width == self._height
+
+    @property
+    def is_vertical(self):
+        return self._width < self._height
+
+    @property
+    def outdir(self):
+        '''The directory of the photo derivatives, in the output tree'''
+        return self._settings.get_output_dir(self.dirname)
+
+    @property
+    def thumb_path(self):
+        return os.path.join(self.outdir, self._settings.thumb_prefix + self.filename)
+
+    @property
+    def preview_path(self):
+        return os.path.join(self.outdir, self._settings.preview_prefix + self.filename)
+
+    @property
+    def desc_path(self):
+        return self.path[:-3]+'desc'
+
+    @property
+    def photodir(self):
+        return self._settings.photodir
+
+    @property
+    def href(self):
+        return os.path.join(self.photodir, self.filename)
+
+    @property
+    def thumb(self):
+        return self._get_url(
+            os.path.join(self.photodir, self._settings.thumb_prefix + self.filename),
+            'thumb'
+            )
+
+    @property
+    def preview(self):
+        return self._get_url(
+            os.path.join(self.photodir, self._settings.preview_prefix + self.filename),
+            'preview'
+            )
+
+    @property
+    def prev(self):
+        '''The previous photo of the album, if any'''
+        if self.index is None or self.index == 0:
+            return None
+        return self._photos[self.index - 1]
+
+    @property
+    def next(self):
+        '''The next photo of the album, if any'''
+        if self.index is None or self.index + 1 >= len(self._photos):
+            return None
+        return self._photos[self.index + 1]
+
+    @property
+    def thumb_width(self):
+        return self.get_thumb_size()[0]
+
+    @property
+    def thumb_height(self):
+        return self._settings.thumb_height
+
+    @property
+    def preview_width(self):
+        return self.get_preview_size()[0]
+
+    @property
+    def preview_height(self):
+        return self._settings.preview_height
 
     def _extract_desc(self, default=''):
-        descfile = self.path[:-3]+'desc'
+        descfile = self.desc_path
         if os.path.exists(descfile):
-            self.desc = codecs.open(descfile, 'rb', 'utf8').read().rstrip()
+            with codecs.open(descfile, 'rb', 'utf8') as desc:
+                self.desc = desc.read().rstrip()
         else:
             self.desc = default
 
+    @property
+    def meta(self):
+        '''The photo metadata, as stored in the album metadata cache'''
+        return {
+            'width': self.size[0],
+            'height': self.size[1],
+            'orientation': self.orientation,
+            'date': self.date,
+            }
+
     def get_dimensions(self):
       '''
       helper function to extract width and height and deal with Exif orientation
       '''
-      img = Image.open(self.path)
-      size = img.size
-      rotation = 0
-      # FIXME: use PIL.Image.Exif instead of private method
-      if img._getexif():
-          # extract exif metadata and check whether we need to rotate
-          # the output file. pil does not copy metadata, and we don't
-          # want to lose the orientation.
-          exif = dict((ExifTags.TAGS[k], v) for k, v in img._getexif().items() if k in ExifTags.TAGS)
-          if 'Orientation' in exif:
-              o = exif['Orientation']
-              if o == 8: rotation = 90
-              if o == 3: rotation = 180
-              if o == 6: rotation = 270
-              if o in (8, 6):
-                  # swap height and width when rotation is 90 or 270
-                  rsize = (size[1], size[0])
-                  size = rsize
-      if rotation > 0:
-          # Exif orientation is set, we need to reflect it in our data
-          verbose ('{} needs orientation fix: {}°'.format(self.path, rotation))
-      return size
+      return self._width, self._height
+
+    def get_srcset(self):
+        '''
+        Returns the responsive images ladder of the photo, i.e. smaller
+        versions of the photo for each of the [photos] `srcset_widths` and
+        `srcset_formats`, as a list of
+        (kind, path, url, (width, height), format) tuples.
+        Widths larger than the photo itself are skipped.
+        '''
+        settings = self._settings
+        prefix = settings.srcset_prefix
+        stem = os.path.splitext(self.filename)[0]
+        ladder = []
+        for width in settings.srcset_widths:
+            if width >= self.width:
+                continue
+            size = (width, int(round(width * self.height / (self.width*1.0))))
+            for fmt in settings.srcset_formats:
+                name = '%s%d_%s.%s'%(prefix, width, stem, SRCSET_FORMATS[fmt])
+                ladder.append((
+                    'srcset_%d_%s'%(width, fmt),
+                    os.path.join(self.outdir, name),
+                    os.path.join(self.photodir, name),
+                    size,
+                    fmt
+                    ))
+        return ladder
+
+    def _get_url(self, url, kind):
+        '''Returns the URL of a derivative, with its version if any'''
+        if not self.versions:
+            return url
+        version = self.versions.get(kind)
+        if version is None:
+            return url
+        return '%s?v=%s'%(url, version[:VERSION_LENGTH])
+
+    def set_versions(self, versions):
+        '''
+        Sets the versions of the derivatives (e.g. their build state), as a
+        dict indexed by derivative kind. Versions are appended to derivative
+        URLs, so that these URLs change whenever derivatives are regenerated.
+        '''
+        self.versions = versions or None
+
+    @property
+    def srcset(self):
+        '''The responsive images ladder, as (url, width, format) tuples'''
+        return [
+            (self._get_url(url, kind), size[0], fmt)
+            for kind, _, url, size, fmt in self.get_srcset()
+            ]
+
+    def get_srcset_string(self, fmt=None):
+        '''
+        Returns a `srcset` attribute value listing the preview and the
+        responsive images of format `fmt` (default: the first configured
+        format). Without responsive images, the original photo is listed.
+        '''
+        if fmt is None:
+            formats = self._settings.srcset_formats
+            fmt = formats[0] if formats else None
+        candidates = [(self.preview, self.preview_width)]
+        ladder = [(url, width) for url, width, f in self.srcset if f == fmt]
+        if ladder:
+            candidates.extend(ladder)
+        else:
+            candidates.append((self.href, self.width))
+        return ', '.join(
+            '%s %dw'%(url, width)
+            for url, width in sorted(candidates, key=lambda c: c[1])
+            )
 
     def _get_size(self, height):
         return int(height * self.width / (self.height*1.0))
 
     def get_thumb_size(self):
-        thumb_height = self.config.getint('photos', 'thumb_height')
+        thumb_height = self._settings.thumb_height
         thumb_width  = self._get_size(thumb_height)
         return thumb_width, thumb_height
 
     def get_preview_size(self):
-        preview_height = self.config.getint('photos', 'preview_height')
+        preview_height = self._settings.preview_height
         preview_width  = self._get_size(preview_height)
         return preview_width, preview_height
 
@@ -0,0 +1,136 @@
+# encoding: utf-8
+
+'''
+Implementation of the I/O pipeline, used when originals live on slow or
+network storage: reader threads prefetch the next originals into memory
+while the current photo is being processed, and writer threads write the
+encoded derivatives in the background. The number of originals read ahead,
+and the memory they use, are bounded.
+'''
+
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .imaging import _gen_derivatives_task
+from .memory import MemoryBudget
+from .output import write_file
+
+# Pipeline shared by all the albums built by the process, see get_pipeline()
+_pipeline = None
+_lock = threading.Lock()
+
+
+def get_pipeline(config):
+    '''
+    Returns the Pipeline configured by the [global] prefetch (number of
+    originals read ahead), prefetch_memory (in MiB) and io_threads options,
+    or None if prefetching is disabled. The pipeline is shared by all the
+    albums built concurrently, so that they share its memory cap.
+    '''
+    global _pipeline
+    depth = config.getint('global', 'prefetch', fallback=0)
+    if depth <= 0:
+        return None
+    memory = config.getint('global', 'prefetch_memory', fallback=256)
+    threads = config.getint('global', 'io_threads', fallback=2)
+    key = (depth, max(memory, 1) * 1024 * 1024, max(threads, 1))
+    with _lock:
+        if _pipeline is None or _pipeline.key != key:
+            _pipeline = Pipeline(*key)
+        return _pipeline
+
+def _get_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+def _read(path):
+    '''
+    Returns the content of `path`, or None if it can not be read: the
+    original is then opened again by the image processing code, which
+    reports the error.
+    '''
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except (IOError, OSError):
+        return None
+
+def _wait_writes(task, result, writes):
+    '''
+    Waits for the background writes of a task, returns its (task, result)
+    tuple, where the first write error (if any) is reported as the error
+    '''
+    err, stats = result
+    for future in writes:
+        try:
+            future.result()
+        except Exception as e:
+            if err is None:
+                err = u'{}'.format(e)
+    return task, (err, stats)
+
+
+class Pipeline(object):
+    '''
+    The Pipeline class prefetches originals (at most `depth` files and
+    `memory` bytes ahead) with `threads` reader threads, and writes encoded
+    derivatives with as many writer threads.
+    '''
+    def __init__(self, depth, memory, threads):
+        self.key     = (depth, memory, threads)
+        self.depth   = depth
+        self.threads = threads
+        self._budget = MemoryBudget(memory)
+
+    def release(self, size):
+        '''Releases the memory of a prefetched original, once processed'''
+        self._budget.release(size)
+
+    def prefetch(self, args):
+        '''
+        Yields (arguments, size) tuples, where `arguments` are the items of
+        `args` (_gen_derivatives_task arguments) along with the content of
+        their original, read ahead by reader threads, and `size` the memory
+        reserved for it, to be released with release().
+        '''
+        queue = deque(args)
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.threads) as readers:
+            while queue or pending:
+                while queue and len(pending) < self.depth:
+                    size = _get_size(queue[0][0])
+                    # only wait for memory when no read is pending
+                    if not self._budget.acquire(size, blocking=not pending):
+                        break
+                    a = queue.popleft()
+                    pending.append((a, size, readers.submit(_read, a[0])))
+                a, size, future = pending.popleft()
+                yield tuple(a) + (future.result(),), size
+
+    def run(self, args, tasks):
+        '''
+        Generates the derivatives of `tasks` in the current thread, from
+        prefetched originals, and writes them in the background. Yields
+        (task, (error, stats)) tuples, once the derivatives of a task are
+        written.
+        '''
+        with ThreadPoolExecutor(max_workers=self.threads) as writers:
+            previous = None
+            for (a, size), task in zip(self.prefetch(args), tasks):
+                writes = []
+                def write(path, data, writes=writes):
+                    writes.append(writers.submit(write_file, path, data))
+                try:
+                    result = _gen_derivatives_task(a, write=write)
+                finally:
+                    self.release(size)
+                # the previous task was written while this one was processed
+                if previous is not None:
+                    yield _wait_writes(*previous)
+                previous = (task, result, writes)
+            if previous is not None:
+                yield _wait_writes(*previous)
@@ -0,0 +1,322 @@
+# encoding: utf-8
+
+'''
+Implementation of the build planner (--plan), which walks an AlbumSet tree
+the way TreeBuilder would, and lists the derivatives, archives and index
+pages which would be generated, and why. Nothing is decoded or written:
+costs are estimated from pixel counts and file sizes.
+'''
+
+import os
+import os.path
+
+from .archive import plan_archive
+from .imaging import estimate_decoded_size, read_metadata, _get_min_size
+
+# Rough single-core processing rates, used to estimate costs
+DECODE_RATE = 100e6    # decoded pixels per second
+RESIZE_RATE = 200e6    # resampled pixels (source image) per second
+ENCODE_RATE = 50e6     # encoded pixels per second
+ZIP_RATE    = 200e6    # archived bytes per second
+RENDER_TIME = 0.005    # seconds per rendered page
+RENDER_RATE = 20000.0  # photos per second, when rendering pages
+
+
+def _estimate_photo(path, size, targets, square, max_pixels):
+    '''
+    Returns the estimated cost (in seconds) of generating `targets` (a list
+    of (path, size, encoder) tuples) and `square` from an original of `size`
+    pixels
+    '''
+    width, height = estimate_decoded_size(
+        path,
+        size,
+        _get_min_size(targets, square),
+        max_pixels
+        )
+    pixels = sum(s[0] * s[1] for _, s, _ in targets)
+    if square is not None:
+        pixels += square[1] * square[1]
+    return (
+        width * height / DECODE_RATE
+        + width * height / RESIZE_RATE
+        + pixels / ENCODE_RATE
+        )
+
+def _plan_derivatives(album, photo, square):
+    '''
+    Returns the plan of the derivatives of `photo`, or None if they are up
+    to date. `square` is the album thumbnail path, if it is generated from
+    this photo.
+    '''
+    targets = []
+    linked = []
+    for kind, path, size in album._get_derivatives(photo):
+        state = album._derivative_state(photo, kind, size)
+        reason = album._get_derivative_reason(photo, kind, path, state)
+        if reason is None:
+            continue
+        target = {'kind': kind, 'path': path, 'size': list(size), 'reason': reason}
+        # forced regeneration does not use the store, see _fetch_derivatives
+        if album.store is not None and album.regen is not True:
+            key = album.store.get_key(
+                album._get_hash(photo),
+                path,
+                size,
+                album._get_encoder(kind)
+                )
+            if album.store.has(key, path):
+                target['reason'] = u'{}, linked from the store'.format(reason)
+                linked.append(target)
+                continue
+        targets.append(target)
+    if not targets and not linked and square is None:
+        return None
+    cost = 0.0
+    if targets or square is not None:
+        cost = _estimate_photo(
+            photo.path,
+            (photo.width, photo.height),
+            [(t['path'], t['size'], None) for t in targets],
+            square and (square, album.thumbnail_size, None),
+            album.max_pixels
+            )
+    return {
+        'photo': photo.path,
+        'pixels': photo.width * photo.height,
+        'targets': targets + linked,
+        'thumbnail': square,
+        'cost': cost,
+        }
+
+def _plan_thumbnail(album, thumbnail, thumb_src, reason):
+    '''Returns the plan of an album thumbnail generated from another file'''
+    plan = {'path': thumbnail, 'source': thumb_src, 'reason': reason, 'cost': 0.0}
+    try:
+        meta = read_metadata(thumb_src)
+    except (IOError, OSError):
+        plan['reason'] = 'source not found'
+        return plan
+    size = (meta['width'], meta['height'])
+    plan['cost'] = _estimate_photo(
+        thumb_src,
+        size,
+        [],
+        (thumbnail, album.thumbnail_size, None),
+        album.max_pixels
+        )
+    return plan
+
+def _plan_archive(album):
+    '''Returns the plan of the album archive, or None if it is up to date'''
+    files = [
+        (p.path, os.path.join(album.photodir, p.filename))
+        for p in album._photos
+        ]
+    action, reason, files = plan_archive(
+        album._get_output_path(album.archive),
+        files,
+        album.regen
+        )
+    if action is None:
+        return None
+    size = sum(os.path.getsize(path) for path, _ in files)
+    return {
+        'path': album._get_output_path(album.archive),
+        'action': action,
+        'reason': reason,
+        'files': len(files),
+        'bytes': size,
+        'cost': size / ZIP_RATE,
+        }
+
+def _plan_render(album, output_file='index.html'):
+    '''Returns the plan of the album pages, or None if they are up to date'''
+    for p in album._photos:
+        if p.desc is None:
+            album._extract_desc(p)
+        if album.versioned_urls:
+            album._set_versions(p)
+    pages = album._get_pages(output_file)
+    chunks = album._get_chunks()
+    filenames = album._get_rendered_files(pages, chunks)
+    reason = album._get_render_reason(output_file, album._render_state(), filenames)
+    if reason is None:
+        return None
+    return {
+        'files': [album._get_output_path(f) for f in filenames],
+        'reason': reason,
+        'cost': len(pages) * RENDER_TIME + album.count / RENDER_RATE,
+        }
+
+def plan_album(album, build=True):
+    '''
+    Returns the plan of an album (as a JSON-serializable dict): photo
+    derivatives, album thumbnail and archive when `build` is set, and
+    album pages
+    '''
+    plan = {
+        'url': album.url,
+        'path': album.path,
+        'photos': album.count,
+        'derivatives': [],
+        'thumbnail': None,
+        'archive': None,
+        'render': None,
+        }
+    if build:
+        album._order()
+        thumbnail, thumb_src = album._get_thumbnail_paths()
+        thumb_photo = None
+        reason = album._get_thumbnail_reason(
+            thumbnail,
+            album._thumbnail_state(thumb_src)
+            )
+        if reason is not None:
+            thumb_photo = album._find_photo(thumb_src)
+            if thumb_photo is None and thumb_src != '':
+                plan['thumbnail'] = _plan_thumbnail(
+                    album,
+                    thumbnail,
+                    thumb_src,
+                    reason
+                    )
+        for p in album._photos:
+            album._extract_desc(p)
+            square = None
+            if p is thumb_photo:
+                square = thumbnail
+                # generated along with the photo derivatives: no extra cost
+                plan['thumbnail'] = {
+                    'path': thumbnail,
+                    'source': p.path,
+                    'reason': reason,
+                    'cost': 0.0,
+                    }
+            derivatives = _plan_derivatives(album, p, square)
+            if derivatives is not None:
+                plan['derivatives'].append(derivatives)
+        if album.archive != '':
+            plan['archive'] = _plan_archive(album)
+    plan['render'] = _plan_render(album)
+    plan['cost'] = (
+        sum(d['cost'] for d in plan['derivatives'])
+        + sum(plan[k]['cost'] for k in ('thumbnail', 'archive', 'render') if plan[k])
+        )
+    return plan
+
+def _plan_index(albumset, output_file='index.html'):
+    '''Returns the plan of an album set index, or None if it is up to date'''
+    path = os.path.join(albumset.output, output_file)
+    if albumset.regen:
+        reason = 'forced'
+    elif not os.path.isfile(path):
+        reason = 'missing'
+    elif albumset.cache.get_output(output_file) != albumset._render_state():
+        reason = 'outdated'
+    else:
+        return None
+    return {'url': albumset.url, 'path': path, 'reason': reason, 'cost': RENDER_TIME}
+
+def _walk(albumset, plan, render=True):
+    '''Adds the plans of the albums and indexes of `albumset` to `plan`'''
+    build = albumset._build_albums
+    for child in albumset.children:
+        if child.type == 'albumset':
+            _walk(child, plan, albumset._recurse)
+        elif albumset._merge:
+            continue
+        elif build or albumset.regen:
+            plan['albums'].append(plan_album(child, build))
+    # sharded builds don't render indexes
+    if render and albumset._shard is None:
+        index = _plan_index(albumset)
+        if index is not None:
+            plan['indexes'].append(index)
+
+def make_plan(root, jobs=1):
+    '''
+    Returns the plan of the build of `root` (an Album, or an AlbumSet and
+    its tree), as a JSON-serializable dict. The estimated duration assumes
+    image processing scales with `jobs`.
+    '''
+    plan = {'albums': [], 'indexes': []}
+    if root.type == 'album':
+        plan['albums'].append(plan_album(root))
+    else:
+        _walk(root, plan)
+    images = sum(
+        sum(d['cost'] for d in a['derivatives'])
+        + (a['thumbnail']['cost'] if a['thumbnail'] else 0)
+        for a in plan['albums']
+        )
+    cost = sum(a['cost'] for a in plan['albums']) + sum(
+        i['cost'] for i in plan['indexes']
+        )
+    plan['total'] = {
+        'albums': len([a for a in plan['albums'] if _is_active(a)]),
+        'photos': sum(len(a['derivatives']) for a in plan['albums']),
+        'derivatives': sum(
+            len(d['targets']) for a in plan['albums'] for d in a['derivatives']
+            ),
+        'archives': len([a for a in plan['albums'] if a['archive']]),
+        'indexes': len(plan['indexes']) + len(
+            [a for a in plan['albums'] if a['render']]
+            ),
+        'cost': cost,
+        'duration': cost - images + images / max(jobs, 1),
+        'jobs': jobs,
+        }
+    return plan
+
+def _is_active(album):
+    '''Checks whether an album plan holds anything to do'''
+    return bool(
+        album['derivatives'] or album['thumbnail'] or album['archive']
+        or album['render']
+        )
+
+def format_plan(plan):
+    '''Returns a plan as text, one line per generated file'''
+    lines = []
+    for album in plan['albums']:
+        if not _is_active(album):
+            continue
+        lines.append(u'Album [{}]: {:.1f}s'.format(album['url'], album['cost']))
+        for d in album['derivatives']:
+            for t in d['targets']:
+                lines.append(u'    {} {}x{} ({})'.format(
+                    t['path'],
+                    t['size'][0],
+                    t['size'][1],
+                    t['reason']
+                    ))
+        if album['thumbnail']:
+            lines.append(u'    {} (album thumbnail, {})'.format(
+                album['thumbnail']['path'],
+                album['thumbnail']['reason']
+                ))
+        if album['archive']:
+            lines.append(u'    {} ({} {} files, {} bytes: {})'.format(
+                album['archive']['path'],
+                album['archive']['action'],
+                album['archive']['files'],
+                album['archive']['bytes'],
+                album['archive']['reason']
+                ))
+        if album['render']:
+            for path in album['render']['files']:
+                lines.append(u'    {} ({})'.format(path, album['render']['reason']))
+    for index in plan['indexes']:
+        lines.append(u'Index [{}]: {} ({})'.format(
+            index['url'] or '/',
+            index['path'],
+            index['reason']
+            ))
+    total = plan['total']
+    lines.append(
+        u'Total: {derivatives} derivatives of {photos} photos in {albums} '
+        u'albums, {archives} archives, {indexes} pages; estimated '
+        u'{duration:.1f}s with {jobs} jobs ({cost:.1f}s of processing)'.format(**total)
+        )
+    return u'\n'.join(lines)
@@ -0,0 +1,211 @@
+# encoding: utf-8
+
+'''
+Implementation of the build profiler, which measures the time spent in each
+build stage (scanning, Exif parsing, decoding, resizing, encoding, zipping,
+rendering) for each album.
+'''
+
+import functools
+import json
+import threading
+import time
+import codecs
+
+# Counters recorded for each (album, stage) pair
+FIELDS = ('wall', 'cpu', 'calls', 'bytes_read', 'bytes_written', 'images')
+
+
+class _NullStage(object):
+    '''Stage returned when profiling is disabled: does nothing'''
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def add(self, **counters):
+        pass
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage(object):
+    '''Context manager measuring a single run of a build stage'''
+    def __init__(self, profiler, name):
+        self._profiler = profiler
+        self._name     = name
+        self._counters = {}
+
+    def __enter__(self):
+        self._wall = time.perf_counter()
+        self._cpu  = time.thread_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._profiler._record(
+            self._name,
+            time.perf_counter() - self._wall,
+            time.thread_time() - self._cpu,
+            self._counters
+            )
+        return False
+
+    def add(self, **counters):
+        '''Adds to the stage counters (bytes_read, bytes_written, images)'''
+        for key, value in counters.items():
+            self._counters[key] = self._counters.get(key, 0) + value
+
+
+class _Scope(object):
+    '''Context manager setting the album current stages are accounted to'''
+    def __init__(self, profiler, album):
+        self._profiler = profiler
+        self._album    = album
+
+    def __enter__(self):
+        self._previous = getattr(self._profiler._local, 'album', None)
+        self._profiler._local.album = self._album
+        return self
+
+    def __exit__(self, *exc_info):
+        self._profiler._local.album = self._previous
+        return False
+
+
+class Profiler(object):
+    '''
+    The Profiler class accumulates timers and counters for each build stage
+    and album. When disabled (the default), stage() and scope() return a
+    shared no-op context manager, so instrumentation costs next to nothing.
+    '''
+    def __init__(self):
+        self.enabled = False
+        self._stats  = {}
+        self._start  = None
+        self._lock   = threading.Lock()
+        self._local  = threading.local()
+
+    def start(self):
+        '''Enables the profiler and starts the global timers'''
+        self.enabled = True
+        self._stats = {}
+        self._start = (time.perf_counter(), time.process_time())
+
+    def stage(self, name):
+        '''Returns a context manager measuring the build stage `name`'''
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name)
+
+    def scope(self, album):
+        '''
+        Returns a context manager accounting the stages run by the current
+        thread to `album`
+        '''
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Scope(self, album)
+
+    def _record(self, name, wall, cpu, counters, calls=1):
+        album = getattr(self._local, 'album', None) or '-'
+        with self._lock:
+            stats = self._stats.setdefault(album, {}).setdefault(
+                name,
+                dict((field, 0) for field in FIELDS)
+                )
+            stats['wall'] += wall
+            stats['cpu'] += cpu
+            stats['calls'] += calls
+            for key, value in counters.items():
+                stats[key] += value
+
+    def pop(self):
+        '''
+        Returns and clears the stages recorded so far, regardless of their
+        album. Used to send the stats of worker processes back.
+        '''
+        with self._lock:
+            stats = _total(self._stats)
+            self._stats = {}
+        return stats
+
+    def merge(self, stats):
+        '''Accounts stages returned by pop() to the current album'''
+        if not self.enabled or not stats:
+            return
+        for name, values in stats.items():
+            counters = dict(
+                (field, values[field])
+                for field in ('bytes_read', 'bytes_written', 'images')
+                )
+            self._record(
+                name,
+                values['wall'],
+                values['cpu'],
+                counters,
+                values['calls']
+                )
+
+    def report(self):
+        '''Returns the profiling report, as a JSON-serializable dict'''
+        with self._lock:
+            albums = dict(
+                (album, dict(
+                    (name, _summarize(values))
+                    for name, values in stages.items()
+                    ))
+                for album, stages in self._stats.items()
+                )
+            stages = _total(self._stats)
+        report = {
+            'stages': dict(
+                (name, _summarize(values)) for name, values in stages.items()
+                ),
+            'albums': albums,
+            }
+        if self._start is not None:
+            report['total'] = {
+                'wall': time.perf_counter() - self._start[0],
+                'cpu': time.process_time() - self._start[1],
+                }
+        return report
+
+    def write(self, path):
+        '''Writes the profiling report to `path`, as JSON'''
+        with codecs.open(path, 'wb', 'utf8') as out:
+            json.dump(self.report(), out, indent=2, sort_keys=True)
+
+
+def _total(stats):
+    '''Sums the stage counters of all albums'''
+    total = {}
+    for album in stats.values():
+        for name, values in album.items():
+            stage = total.setdefault(name, dict((field, 0) for field in FIELDS))
+            for field in FIELDS:
+                stage[field] += values[field]
+    return total
+
+def _summarize(values):
+    '''Adds throughput figures to the counters of a stage'''
+    summary = dict(values)
+    if values['images'] > 0 and values['wall'] > 0:
+        summary['images_per_second'] = values['images'] / values['wall']
+    return summary
+
+# instanciate a profiler object, which can be used (and enabled) globally
+profiler = Profiler()
+
+def scoped(method):
+    '''
+    Decorator for Album and AlbumSet methods: the stages they run are
+    accounted to the album (or album set) URL
+    '''
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if not profiler.enabled:
+            return method(self, *args, **kwargs)
+        with profiler.scope(self.url):
+            return method(self, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,78 @@
+# encoding: utf-8
+
+'''
+Implementation of the render engine: a process-wide jinja2 environment
+shared by all albums and album sets.
+'''
+
+import os
+import os.path
+import threading
+
+from .assets import get_asset_lookup, assets_signature, get_assets_key
+from .cache import file_signature, signature
+
+# jinja2 environments, indexed by (templatedir, bytecode cache directory).
+# Each environment compiles a given template only once per process.
+_environments = {}
+# template signatures, indexed by path and validated with (size, mtime)
+_signatures = {}
+_lock = threading.Lock()
+
+
+def get_environment(config):
+    '''
+    Returns the jinja2 environment matching the [global] `templatedir` of
+    `config`. If `bytecode_cache` is set, compiled templates are also stored
+    in that directory, so subsequent runs don't need to compile them again.
+    Templates can use the asset() function to get the content-hashed URL of
+    a static asset (see sphog.assets).
+    '''
+    # jinja2 is only imported when a page is actually rendered
+    from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+    templatedir = config.get('global', 'templatedir')
+    cachedir = config.get('global', 'bytecode_cache', fallback='')
+    key = (templatedir, cachedir, get_assets_key(config))
+    with _lock:
+        env = _environments.get(key)
+        if env is None:
+            bytecode_cache = None
+            if cachedir != '':
+                if not os.path.isdir(cachedir):
+                    os.makedirs(cachedir)
+                bytecode_cache = FileSystemBytecodeCache(cachedir)
+            env = Environment(
+                loader=FileSystemLoader(searchpath=templatedir),
+                bytecode_cache=bytecode_cache
+                )
+            env.globals['asset'] = get_asset_lookup(config)
+            _environments[key] = env
+    return env
+
+def get_template(config, name):
+    '''Returns the compiled template `name`'''
+    return get_environment(config).get_template(name)
+
+def template_signature(config, name):
+    '''
+    Returns a signature of the content of template `name`, and of the
+    hashed URLs of the site assets it may use. The template file is only
+    read again when its size or mtime changed.
+    '''
+    path = os.path.join(config.get('global', 'templatedir'), name)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    with _lock:
+        cached = _signatures.get(path)
+    if cached is not None and cached[0] == (stat.st_size, stat.st_mtime):
+        sig = cached[1]
+    else:
+        sig = file_signature(path)
+        with _lock:
+            _signatures[path] = ((stat.st_size, stat.st_mtime), sig)
+    assets = assets_signature(config)
+    if assets is None:
+        return sig
+    return signature(sig, assets)
@@ -3,6 +3,8 @@ class Settings(object):
 		self._verbose = False
 		self._info = True
 		self._quiet = False
+		self._jobs = None
+		self._dry_run = False
 
 	@property
 	def verbose(self):
@@ -28,6 +30,22 @@ class Settings(object):
 	def quiet(self, value):
 		self._quiet = value
 
+	@property
+	def jobs(self):
+		return self._jobs
+
+	@jobs.setter
+	def jobs(self, value):
+		self._jobs = value
+
+	@property
+	def dry_run(self):
+		return self._dry_run
+
+	@dry_run.setter
+	def dry_run(self, value):
+		self._dry_run = value
+
 # instanciate a settings object with default value, 
 # which can be used (and updated) globally
 settings = Settings()
@@ -0,0 +1,85 @@
+# encoding: utf-8
+
+'''
+Implementation of sharded builds: the albums of a site tree are split
+deterministically across several independent builds (--shard i/N), which
+each build their own albums, and write a summary of each album. A merge
+build (--merge) then renders the album set indexes from these summaries,
+without needing the photos.
+'''
+
+import os
+import os.path
+import json
+import hashlib
+
+from .output import get_output_path, write_output
+
+# Album summary file, written to the album (output) directory
+SUMMARY = '.sphog.summary'
+# Album attributes used by album set indexes
+SUMMARY_FIELDS = ('url', 'name', 'desc', 'index_desc', 'date', 'count', 'thumbnail')
+
+
+def parse_shard(value):
+    '''
+    Parses a shard specification ("i/N", with 1 <= i <= N), returns an
+    (i, N) tuple. Raises ValueError if the specification is invalid.
+    '''
+    try:
+        index, count = (int(v) for v in value.split('/'))
+    except ValueError:
+        raise ValueError(u'Invalid shard [{}], expected i/N'.format(value))
+    if count < 1 or not 1 <= index <= count:
+        raise ValueError(u'Invalid shard [{}], expected 1 <= i <= N'.format(value))
+    return index, count
+
+def in_shard(config, path, shard):
+    '''
+    Checks whether the album located in `path` belongs to `shard` (an
+    (i, N) tuple, or None when the build is not sharded). Albums are
+    assigned by a hash of their path relative to the site root, so that all
+    the shards agree, whatever host they run on.
+    '''
+    if shard is None:
+        return True
+    index, count = shard
+    relpath = os.path.relpath(path, config.get('global', 'siteroot'))
+    digest = hashlib.sha1(relpath.replace(os.sep, '/').encode('utf8')).hexdigest()
+    return int(digest, 16) % count == index - 1
+
+def write_summary(album):
+    '''
+    Writes the summary of `album`, i.e. the attributes used by album set
+    indexes, to its output directory
+    '''
+    write_output(
+        os.path.join(album.output, SUMMARY),
+        json.dumps(
+            dict((f, getattr(album, f)) for f in SUMMARY_FIELDS),
+            indent=2,
+            sort_keys=True
+            )
+        )
+
+
+class AlbumSummary(object):
+    '''
+    The AlbumSummary class stands for an album in album set indexes, from
+    the summary written by the build of the album (see write_summary).
+    '''
+    def __init__(self, path, summary):
+        self.path = path
+        self.type = 'album'
+        for f in SUMMARY_FIELDS:
+            setattr(self, f, summary.get(f))
+
+    @classmethod
+    def load(cls, config, path):
+        '''
+        Returns the summary of the album located in `path`. Raises IOError
+        (or ValueError) if the album has no valid summary.
+        '''
+        summary = os.path.join(get_output_path(config, path), SUMMARY)
+        with open(summary, 'rb') as f:
+            return cls(path, json.loads(f.read().decode('utf8')))
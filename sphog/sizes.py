@@ -0,0 +1,112 @@
+# encoding: utf-8
+
+'''
+Implementation of the size report, which compares the size of regenerated
+derivatives with the size of the files they replace, for each album and
+derivative type, along with the encoder options used.
+'''
+
+import json
+import threading
+import codecs
+
+from .utils import info
+
+# Counters recorded for each (album, derivative type) pair
+FIELDS = ('files', 'bytes_before', 'bytes_after', 'new_files', 'new_bytes')
+
+
+class SizeReport(object):
+    '''
+    The SizeReport class accumulates the size of regenerated derivatives.
+    Files which did not exist before are accounted separately, so that
+    savings only compare a file with its previous version.
+    '''
+    def __init__(self):
+        self.enabled   = False
+        self._stats    = {}
+        self._encoders = {}
+        self._lock     = threading.Lock()
+
+    def start(self):
+        '''Enables the size report'''
+        self.enabled = True
+        self._stats = {}
+        self._encoders = {}
+
+    def record(self, album, kind, encoder, before, after):
+        '''
+        Records a derivative of type `kind` of `album`, generated with the
+        `encoder` options. `before` is the size of the previous version of
+        the file (None if there was none), and `after` its new size.
+        '''
+        if not self.enabled:
+            return
+        with self._lock:
+            stats = self._stats.setdefault(album, {}).setdefault(
+                kind,
+                dict((field, 0) for field in FIELDS)
+                )
+            if before is None:
+                stats['new_files'] += 1
+                stats['new_bytes'] += after
+            else:
+                stats['files'] += 1
+                stats['bytes_before'] += before
+                stats['bytes_after'] += after
+            self._encoders.setdefault(album, {})[kind] = encoder
+
+    def report(self):
+        '''Returns the size report, as a JSON-serializable dict'''
+        with self._lock:
+            albums = {}
+            total = {}
+            for album, kinds in self._stats.items():
+                albums[album] = {}
+                for kind, values in kinds.items():
+                    albums[album][kind] = _summarize(values)
+                    albums[album][kind]['encoder'] = self._encoders[album][kind]
+                    stats = total.setdefault(
+                        kind,
+                        dict((field, 0) for field in FIELDS)
+                        )
+                    for field in FIELDS:
+                        stats[field] += values[field]
+        return {
+            'albums': albums,
+            'total': dict(
+                (kind, _summarize(values)) for kind, values in total.items()
+                ),
+            }
+
+    def print_summary(self):
+        '''Prints the byte savings of each derivative type'''
+        for kind, values in sorted(self.report()['total'].items()):
+            info(u'{}: {} files, {} -> {} bytes ({:+.1f}%), {} new files ({} bytes)'.format(
+                kind,
+                values['files'],
+                values['bytes_before'],
+                values['bytes_after'],
+                -values['savings'] * 100,
+                values['new_files'],
+                values['new_bytes']
+                ))
+
+    def write(self, path):
+        '''Writes the size report to `path`, as JSON'''
+        with codecs.open(path, 'wb', 'utf8') as out:
+            json.dump(self.report(), out, indent=2, sort_keys=True)
+
+
+def _summarize(values):
+    '''Adds the savings ratio to the counters of a derivative type'''
+    summary = dict(values)
+    summary['saved_bytes'] = values['bytes_before'] - values['bytes_after']
+    if values['bytes_before'] > 0:
+        summary['savings'] = summary['saved_bytes'] / values['bytes_before']
+    else:
+        summary['savings'] = 0.0
+    return summary
+
+# instanciate a size report object, which can be used (and enabled) globally
+size_report = SizeReport()
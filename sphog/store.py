@@ -0,0 +1,146 @@
+# encoding: utf-8
+
+'''
+Implementation of the site-level derivative store: a content-addressed
+directory holding the derivatives of all albums, keyed by the content of the
+original photo and by the derivative parameters. Albums link their
+derivatives from the store, so a photo found in several albums is only
+decoded and resized once.
+'''
+
+import os
+import os.path
+import hashlib
+import shutil
+import threading
+
+from .cache import signature
+from .utils import warn
+
+# Size of the chunks read when hashing originals
+CHUNK_SIZE = 1024 * 1024
+
+# Ways of linking store entries to album files
+LINK_MODES = ('hardlink', 'symlink', 'copy')
+
+
+def get_store(config):
+    '''
+    Returns the DerivativeStore configured by the [global] store option, or
+    None if there is none
+    '''
+    path = config.get('global', 'store', fallback='')
+    if path == '':
+        return None
+    link = config.get('global', 'store_link', fallback='hardlink')
+    if link not in LINK_MODES:
+        raise ValueError(u'Invalid store_link value [{}]'.format(link))
+    return DerivativeStore(path, link)
+
+def hash_file(path):
+    '''Returns the SHA-1 hash of the content of `path`'''
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def detach(path):
+    '''
+    Removes `path` if it is shared with a store entry (a hardlink or a
+    symlink), so that regenerating it does not modify the entry
+    '''
+    try:
+        if os.path.islink(path) or os.stat(path).st_nlink > 1:
+            os.remove(path)
+    except OSError:
+        pass
+
+
+class DerivativeStore(object):
+    '''
+    The DerivativeStore class manages the content-addressed derivative store.
+    Entries are immutable: they are added once a derivative has been
+    generated in an album, and then linked (or copied) to other albums
+    needing the same derivative.
+    '''
+    def __init__(self, path, link='hardlink'):
+        self.path = os.path.abspath(path)
+        self.link = link
+
+    def get_key(self, digest, path, *params):
+        '''
+        Returns the store key of a derivative written to `path`, built from
+        the hash of its original and its parameters (size, encoder...)
+        '''
+        return signature(digest, os.path.splitext(path)[1].lower(), params)
+
+    def _get_entry(self, key, path):
+        '''Returns the path of the store entry `key`'''
+        return os.path.join(
+            self.path,
+            key[:2],
+            key + os.path.splitext(path)[1].lower()
+            )
+
+    def has(self, key, path):
+        '''Checks whether the store holds the entry `key`'''
+        return os.path.isfile(self._get_entry(key, path))
+
+    def fetch(self, key, path):
+        '''
+        Links the store entry `key` to `path`. Returns False if the store
+        does not hold this entry yet.
+        '''
+        if not self.has(key, path):
+            return False
+        entry = self._get_entry(key, path)
+        tmp = path + '.tmp'
+        try:
+            if self.link == 'symlink':
+                os.symlink(entry, tmp)
+            else:
+                self._link(entry, tmp)
+            os.replace(tmp, path)
+        except OSError as e:
+            warn(u'Could not link [{}] from the derivative store: {}'.format(
+                path,
+                e
+                ))
+            return False
+        return True
+
+    def add(self, key, path, replace=False):
+        '''
+        Adds the freshly generated derivative `path` to the store. An
+        existing entry is only replaced when `replace` is set (forced
+        regeneration); hardlinks and copies of the previous entry are kept.
+        '''
+        entry = self._get_entry(key, path)
+        if os.path.isfile(entry) and not replace:
+            return
+        tmp = u'{}.{}.{}.tmp'.format(entry, os.getpid(), threading.get_ident())
+        try:
+            os.makedirs(os.path.dirname(entry), exist_ok=True)
+            self._link(path, tmp)
+            os.replace(tmp, entry)
+        except OSError as e:
+            warn(u'Could not add [{}] to the derivative store: {}'.format(
+                path,
+                e
+                ))
+
+    def _link(self, src, dst):
+        '''Hardlinks `src` to `dst`, or copies it (e.g. across devices)'''
+        if os.path.lexists(dst):
+            os.remove(dst)
+        if self.link != 'copy':
+            try:
+                os.link(src, dst)
+                return
+            except OSError:
+                pass
+        shutil.copy2(src, dst)
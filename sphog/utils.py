@@ -1,6 +1,8 @@
 from __future__ import print_function
 import sys
 import os
+import importlib
+import multiprocessing
 from .settings import settings
 
 # Helper functions to report the script status.
@@ -30,3 +32,65 @@ def get_current_path():
 		# python3 returns unicode by default
 		path = os.getcwd()
 	return path
+
+
+
+# Number of parallel jobs: the command line (settings.jobs) overrides the
+# `jobs` key of the [global] config section. 0 means one job per CPU core.
+def get_jobs(config):
+	jobs = settings.jobs
+	if jobs is None:
+		jobs = config.getint('global', 'jobs', fallback=1)
+	if jobs <= 0:
+		jobs = os.cpu_count() or 1
+	return jobs
+
+
+# Multiprocessing context of the image processing pools. Workers are started
+# lazily, from album threads which may hold locks (e.g. stdout, imports):
+# forked workers could inherit these locks held, so they are started by a
+# fork server where available (Unix), and spawned otherwise.
+def get_mp_context():
+	if 'forkserver' in multiprocessing.get_all_start_methods():
+		return multiprocessing.get_context('forkserver')
+	return multiprocessing.get_context('spawn')
+
+
+# Lists the content of a single directory level, as (dirs, files) lists of
+# os.DirEntry objects sorted by name. Unlike os.walk, subdirectories are not
+# visited, and DirEntry objects cache their stat data.
+def scan_dir(path):
+	dirs = []
+	files = []
+	try:
+		entries = list(os.scandir(path))
+	except OSError:
+		return dirs, files
+	for entry in sorted(entries, key=lambda e: e.name):
+		if entry.is_dir():
+			dirs.append(entry)
+		elif entry.is_file():
+			files.append(entry)
+	return dirs, files
+
+
+# Module proxy, importing the module `name` on first attribute access. Heavy
+# dependencies (Pillow, jinja2) are only loaded by the stages which need
+# them, so that the command line stays fast when there is nothing to build.
+# Attributes set on the proxy (e.g. Image.MAX_IMAGE_PIXELS) are set on the
+# module itself.
+class LazyModule(object):
+	def __init__(self, name):
+		object.__setattr__(self, '_name', name)
+		object.__setattr__(self, '_module', None)
+
+	def _load(self):
+		if self._module is None:
+			object.__setattr__(self, '_module', importlib.import_module(self._name))
+		return self._module
+
+	def __getattr__(self, attr):
+		return getattr(self._load(), attr)
+
+	def __setattr__(self, attr, value):
+		setattr(self._load(), attr, value)
@@ -0,0 +1,229 @@
+# encoding: utf-8
+
+'''
+Implementation of the watch mode, which keeps running and rebuilds albums
+(and their parent indexes) when their content changes.
+'''
+
+import os
+import os.path
+import re
+import time
+
+from .album import Album
+from .albumset import AlbumSet
+from .assets import refresh_assets
+from .config import read_config
+from .photo import get_generated_prefixes
+from .shard import in_shard
+from .utils import info, warn, scan_dir
+
+# Album and index definition files
+ALBUM_DEF = 'album.def'
+INDEX_DEF = 'index.def'
+
+
+def _snapshot_album(site_config, path, snapshot):
+    '''Adds the inputs of the album located in `path` to `snapshot`'''
+    config = read_config([site_config, os.path.join(path, ALBUM_DEF)])
+    photodir = os.path.join(path, config.get('album', 'photodir'))
+    generated = '^(%s)' % '|'.join(
+        re.escape(prefix) for prefix in get_generated_prefixes(config)
+        )
+    for entry in scan_dir(photodir)[1]:
+        if re.match(generated, entry.name):
+            continue
+        if not re.match(r'.*\.(jpg|desc)$', entry.name, re.I):
+            continue
+        stat = entry.stat()
+        snapshot[entry.path] = (stat.st_size, stat.st_mtime)
+
+def _get_excluded(site_config, path):
+    '''
+    Returns the names of the subdirectories excluded by the index located in
+    `path`, as AlbumSet does
+    '''
+    config = read_config([site_config, os.path.join(path, INDEX_DEF)])
+    exclude = config.get('directory', 'exclude', fallback='')
+    if exclude == '':
+        return []
+    return [name.strip() for name in exclude.split(',')]
+
+def snapshot(site_config, root):
+    '''
+    Takes a snapshot of the inputs of the site tree located in `root`: the
+    site configuration, definition files, photos and descriptions, but not
+    generated files nor the directories excluded by indexes. Returns a
+    (files, albums, indexes) tuple, where `files` maps paths to their
+    (size, mtime), and `albums` and `indexes` are the sets of album and
+    index directories.
+    '''
+    files = {}
+    albums = set()
+    indexes = set()
+    try:
+        stat = os.stat(site_config)
+        files[site_config] = (stat.st_size, stat.st_mtime)
+    except OSError:
+        pass
+    pending = [root]
+    while pending:
+        path = pending.pop()
+        for name in (ALBUM_DEF, INDEX_DEF):
+            try:
+                stat = os.stat(os.path.join(path, name))
+            except OSError:
+                continue
+            files[os.path.join(path, name)] = (stat.st_size, stat.st_mtime)
+        if os.path.join(path, INDEX_DEF) in files:
+            indexes.add(path)
+            try:
+                exclude = _get_excluded(site_config, path)
+            except Exception as e:
+                warn(u'Could not read index in {}: {}'.format(path, e))
+                exclude = []
+            pending.extend(
+                entry.path for entry in scan_dir(path)[0]
+                if entry.name not in exclude
+                )
+        elif os.path.join(path, ALBUM_DEF) in files:
+            albums.add(path)
+            try:
+                _snapshot_album(site_config, path, files)
+            except Exception as e:
+                warn(u'Could not scan album in {}: {}'.format(path, e))
+    return files, albums, indexes
+
+def _get_changes(previous, current):
+    '''Returns the set of paths which differ between two snapshots'''
+    changed = set()
+    for path in set(previous) | set(current):
+        if previous.get(path) != current.get(path):
+            changed.add(path)
+    return changed
+
+def _get_owner(path, root, albums, indexes):
+    '''
+    Returns the album or index directory `path` belongs to, as an
+    ('album', dir) or ('index', dir) tuple
+    '''
+    d = os.path.dirname(path)
+    while d.startswith(root):
+        if d in albums:
+            return ('album', d)
+        if d in indexes:
+            return ('index', d)
+        parent = os.path.dirname(d)
+        if parent == d:
+            break
+        d = parent
+    return ('index', root)
+
+def _get_ancestors(path, root, indexes):
+    '''Returns the index directories above `path`, up to `root`'''
+    ancestors = []
+    d = path
+    while d != root and d.startswith(root):
+        d = os.path.dirname(d)
+        if d in indexes:
+            ancestors.append(d)
+    return ancestors
+
+def _get_depth(path, root):
+    '''Returns the number of directories between `root` and `path`'''
+    if path == root:
+        return 0
+    return os.path.relpath(path, root).count(os.sep) + 1
+
+def rebuild(site_config, root, changed, albums, indexes, recurse=False,
+            build_albums=False, shard=None, merge=False):
+    '''
+    Rebuilds the albums affected by `changed` paths, then the indexes of
+    their album sets, up to `root`. As in the initial build, the albums of
+    nested album sets are only built with `recurse` and `build_albums`, the
+    nested indexes only with `recurse`, indexes are not rendered in sharded
+    builds (`shard`), and albums are not built in merge builds (`merge`).
+    A change to the site configuration rebuilds the whole tree.
+    '''
+    touched_albums = set()
+    touched_indexes = set()
+    if site_config in changed:
+        touched_albums.update(albums)
+        touched_indexes.update(indexes)
+    for path in changed:
+        if path == site_config:
+            continue
+        kind, owner = _get_owner(path, root, albums, indexes)
+        if kind == 'album':
+            touched_albums.add(owner)
+        else:
+            touched_indexes.add(owner)
+    for path in list(touched_albums) + list(touched_indexes):
+        touched_indexes.update(_get_ancestors(path, root, indexes))
+    config = read_config([site_config])
+    refresh_assets()
+    for path in sorted(touched_albums):
+        depth = _get_depth(path, root)
+        if depth > 0 and (merge or not build_albums or (depth > 1 and not recurse)):
+            continue
+        if not in_shard(config, path, shard):
+            continue
+        try:
+            album = Album(site_config, path=path)
+            album.summary = shard is not None
+            info (u'Building album [{}]'.format(album.base))
+            album.prepare()
+            album.render()
+        except Exception as e:
+            warn(u'something went wrong when building album in {}:\n{}'.format(path, e))
+    # deepest indexes first, so each index sees its rebuilt children
+    for path in sorted(touched_indexes, key=lambda p: p.count(os.sep), reverse=True):
+        if path not in indexes or shard is not None:
+            continue
+        if path != root and not recurse:
+            continue
+        try:
+            albumset = AlbumSet(site_config, path=path, merge=merge)
+            info (u'Building directory index [{}]'.format(albumset.url))
+            albumset.render()
+        except Exception as e:
+            warn(u'something went wrong when building album set in {}\n{}'.format(path, e))
+
+def watch(site_config, root, interval=2.0, debounce=1.0, recurse=False,
+          build_albums=False, shard=None, merge=False):
+    '''
+    Watches the site tree located in `root`, and rebuilds the albums and
+    indexes whose inputs changed, with the options of the initial build
+    (see rebuild). The tree is polled every `interval` seconds; a rebuild
+    only starts once the tree did not change for `debounce` seconds (e.g.
+    while photos are being copied).
+
+    The process keeps parsed configurations, compiled templates and photo
+    metadata caches in memory between rebuilds.
+    '''
+    root = os.path.abspath(root)
+    info (u'Watching {} for changes (press Ctrl+C to stop)'.format(root))
+    previous = snapshot(site_config, root)
+    try:
+        while True:
+            time.sleep(interval)
+            current = snapshot(site_config, root)
+            changed = _get_changes(previous[0], current[0])
+            if not changed:
+                continue
+            # wait for the tree to settle down
+            while True:
+                time.sleep(debounce)
+                latest = snapshot(site_config, root)
+                if latest[0] == current[0]:
+                    break
+                changed |= _get_changes(current[0], latest[0])
+                current = latest
+            info (u'{} changes detected'.format(len(changed)))
+            rebuild(
+                site_config, root, changed, current[1], current[2],
+                recurse, build_albums, shard, merge
+                )
+            previous = current
+    except KeyboardInterrupt:
+        info (u'Stopped watching {}'.format(root))